@@ -0,0 +1,276 @@
+"""
+偽のDiscordクライアントで本物のコマンドハンドラと価格ループに負荷をかけるベンチマーク。
+
+    python -m benchmarks.load_test --users 50 --duration 30 --output bench.json
+
+一時SQLiteファイルを使うので本番DBには触れない。結果はJSONで出力するので、
+前回の結果と比較すれば性能の劣化を検出できる。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import vanitasbot_main
+from commands import stock_manager
+from commands import user_manager
+from commands import ledger
+from commands import price_board
+from commands import tick_bus
+from commands import rate_limiter
+from commands import guilds
+from commands.simulation import use_database
+
+# 仮想ユーザーが操作するサーバー。コマンドは本番と同じく tree.interaction_check でこの市場へ振り分ける
+GUILD_ID = 1
+
+# --- Discord の代役 ---
+
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+class FakeUser:
+    def __init__(self, user_id: int, admin: bool = False):
+        self.id = user_id
+        self.display_name = f"bench-{user_id}"
+        self.roles = [FakeRole("終界主")] if admin else []
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.messages.append(content)
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append(content)
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser):
+        self.user = user
+        self.guild_id = GUILD_ID
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+class FakeClient:
+    """vanitasbot_main.client の代わりに差し込む。送信内容は記録するだけ"""
+
+    def __init__(self):
+        self.channels = {}
+        self.users = {}
+        self._closed = False
+
+    async def wait_until_ready(self):
+        return
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def get_channel(self, channel_id: int):
+        return self.channels.setdefault(channel_id, FakeChannel(channel_id))
+
+    async def fetch_user(self, user_id: int):
+        return self.users.setdefault(user_id, FakeUser(user_id))
+
+    async def close(self):
+        self._closed = True
+
+# --- 計測 ---
+
+def _percentile(values: list[float], pct: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+def _summary(samples: list[float]) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": round(_percentile(samples, 0.50) * 1000, 3) if samples else None,
+        "p99_ms": round(_percentile(samples, 0.99) * 1000, 3) if samples else None,
+        "max_ms": round(max(samples) * 1000, 3) if samples else None,
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3) if samples else None,
+    }
+
+async def _measure_loop_lag(stop: asyncio.Event, samples: list[float], interval: float = 0.05):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+# --- シナリオ ---
+
+SYMBOLS = []
+
+async def _user_session(user: FakeUser, peers: list[FakeUser], stop: asyncio.Event, rng: random.Random,
+                        latencies: dict, rejected: dict, think_time: float):
+    main = vanitasbot_main
+    commands = [
+        ("buy", 4, lambda i: main.買う.callback(i, rng.choice(SYMBOLS), rng.randint(1, 5), rng.choice([0, 0, 1]))),
+        ("sell", 3, lambda i: main.売る.callback(i, rng.choice(SYMBOLS), 0)),
+        ("transfer", 2, lambda i: main.送金.callback(i, rng.choice(peers), float(rng.randint(1, 50)))),
+        ("chart", 1, lambda i: main.株価.callback(i, rng.choice(SYMBOLS))),
+        ("autocomplete", 4, lambda i: main.autocomplete_symbols(i, rng.choice(SYMBOLS)[:rng.randint(0, 3)])),
+    ]
+    names = [c[0] for c in commands]
+    weights = [c[1] for c in commands]
+    by_name = {c[0]: c[2] for c in commands}
+
+    while not stop.is_set():
+        name = rng.choices(names, weights)[0]
+        interaction = FakeInteraction(user)
+        start = time.perf_counter()
+        try:
+            # 本番と同じくサーバーの振り分け・市場の起動確認を通してからハンドラを呼ぶ
+            if await main.tree.interaction_check(interaction):
+                await by_name[name](interaction)
+        except Exception as e:
+            latencies.setdefault(f"{name}_error", []).append(time.perf_counter() - start)
+            print(f"❌ {name}: {e}")
+            continue
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if any(m and m.startswith("⏳") for m in interaction.response.messages):
+            rejected[name] = rejected.get(name, 0) + 1
+        await asyncio.sleep(rng.uniform(0, think_time))
+
+def _seed(symbols: int, users: int, rng: random.Random):
+    stock_manager.init_db()
+    ledger.init_ledger()
+    for i in range(symbols):
+        symbol = f"BN{i:03d}"
+        SYMBOLS.append(symbol)
+        stock_manager.add_stock(symbol, rng.randint(50, 500), 1, 1, 10, 1000 + i, "1")
+    for u in range(users):
+        user_manager.init_user(str(10_000 + u))
+        user_manager.add_balance(str(10_000 + u), 1_000_000)
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="vety-bench-")
+    db_path = os.path.join(workdir, "bench.db")
+    use_database(db_path)
+    os.chdir(workdir)  # /株価 が書き出すグラフも一時ディレクトリに置く
+    rng = random.Random(args.seed)
+    token = guilds.current_guild.set(GUILD_ID)  # 仮想ユーザーのサーバーのDBに用意する
+    try:
+        _seed(args.symbols, args.users, rng)
+        market_db = guilds.db_path(db_path)
+    finally:
+        guilds.current_guild.reset(token)
+
+    client = FakeClient()
+    vanitasbot_main.client = client
+    if args.no_admission:
+        rate_limiter.admission = rate_limiter.AdmissionController(
+            user_rate=1e9, user_burst=1e9, global_rate=1e9, global_burst=1e9)
+
+    # ティック間隔のずれは tick バスの到着時刻から測る
+    tick_arrivals = []
+
+    async def on_tick(batch):
+        tick_arrivals.append(time.monotonic())
+
+    tick_bus.bus.subscribe("price_board", price_board.on_tick, on_lag=price_board.invalidate)
+    tick_bus.bus.subscribe("bench", on_tick)
+
+    stop = asyncio.Event()
+    lag = []
+    latencies = {}
+    rejected = {}
+    users = [FakeUser(10_000 + u) for u in range(args.users)]
+
+    # 価格ループ・自動売却・板の読み込みは本番と同じ市場の起動処理に任せる
+    await vanitasbot_main._ensure_market(GUILD_ID)
+    background = [asyncio.create_task(_measure_loop_lag(stop, lag))]
+    sessions = [
+        asyncio.create_task(_user_session(u, users, stop, random.Random(args.seed + i), latencies, rejected, args.think_time))
+        for i, u in enumerate(users)
+    ]
+
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*sessions, return_exceptions=True)
+    await client.close()
+    for engine in list(vanitasbot_main.engines.values()):
+        await engine.stop()
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    intervals = [b - a for a, b in zip(tick_arrivals, tick_arrivals[1:])]
+    drift = [abs(i - 1.0) for i in intervals]
+    return {
+        "config": {
+            "users": args.users,
+            "symbols": args.symbols,
+            "duration_sec": args.duration,
+            "think_time_sec": args.think_time,
+            "admission": not args.no_admission,
+            "seed": args.seed,
+        },
+        "commands": {name: _summary(samples) for name, samples in sorted(latencies.items())},
+        "rejected": rejected,
+        "ticks": len(tick_arrivals),
+        "tick_interval": _summary(intervals),
+        "tick_drift": _summary(drift),
+        "event_loop_lag": _summary(lag),
+        "channel_messages": sum(len(c.sent) for c in client.channels.values()),
+        "db": market_db,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="偽クライアントによる負荷試験")
+    parser.add_argument("--users", type=int, default=20, help="同時に操作する仮想ユーザー数")
+    parser.add_argument("--symbols", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=15, help="計測時間（秒）")
+    parser.add_argument("--think-time", type=float, default=0.5, help="操作間の最大待ち時間（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-admission", action="store_true", help="受付制限を無効にして素の性能を測る")
+    parser.add_argument("--output", help="結果JSONの保存先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
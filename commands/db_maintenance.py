@@ -0,0 +1,208 @@
+import asyncio
+import glob
+import os
+import sqlite3
+import time
+from datetime import datetime
+from commands import metrics
+from commands import guilds
+
+# 絶対パスに変換
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
+
+DB_PATH = os.path.join(DB_DIR, "shared.db")
+
+# ティックの合間に走らせる処理の間隔（秒）
+CHECKPOINT_INTERVAL = 30          # PASSIVE: 書き込みを一切待たせない
+TRUNCATE_INTERVAL = 600           # TRUNCATE: WALファイルを0バイトに戻す
+TRUNCATE_WAL_PAGES = 4000         # WALがこのページ数を超えたら間隔を待たずに TRUNCATE
+OPTIMIZE_INTERVAL = 3600          # PRAGMA optimize（必要な表だけ ANALYZE される）
+VACUUM_INTERVAL = 600             # incremental_vacuum
+VACUUM_PAGES = 200                # 1回に解放する空きページ数の上限
+
+# オンラインバックアップ（0で無効）
+BACKUP_INTERVAL = int(os.getenv("DB_BACKUP_INTERVAL", "21600"))
+BACKUP_KEEP = 3
+BACKUP_STEP_PAGES = 256           # 1ステップでコピーするページ数
+BACKUP_STEP_SLEEP = 0.05          # ステップ間で書き込み側に譲る秒数
+BACKUP_MAX_RESTARTS = 5           # 書き込みでコピーがやり直しになった回数の上限
+
+_next_run = {}  # {(サーバー, 処理名): 次に実行する時刻}
+
+def get_connection():
+    # メンテナンスで書き込みを待たせないよう、ロック待ちは短くする
+    return sqlite3.connect(guilds.db_path(DB_PATH), timeout=1, check_same_thread=False, factory=metrics.InstrumentedConnection)
+
+def backup_dir() -> str:
+    return os.path.join(os.path.dirname(guilds.db_path(DB_PATH)), "backups")
+
+def init_maintenance():
+    """
+    起動時、テーブルを作る前に1回だけ呼ぶ。WALを有効にし、新しいDBなら incremental vacuum にする。
+    既存DBの切り替えは全体を書き直す VACUUM が要るので、ボット停止中に
+    python -m commands.db_maintenance --enable-incremental-vacuum で行う
+    """
+    key = guilds.partition()
+    conn = get_connection()
+    try:
+        # auto_vacuum は最初のテーブルを作る前なら VACUUM なしで変えられる
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("ℹ️ incremental vacuum は無効です（停止中に --enable-incremental-vacuum で有効にできます）")
+    finally:
+        conn.close()
+    for task in [k for k in _next_run if k[0] == key]:
+        del _next_run[task]
+
+def enable_incremental_vacuum():
+    """既存DBを incremental vacuum に切り替える（VACUUM で全体を書き直す。ボット停止中に実行する）"""
+    conn = sqlite3.connect(guilds.db_path(DB_PATH), timeout=30)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+def checkpoint(mode: str = "PASSIVE"):
+    """戻り値は (busy, WALのページ数, 書き戻したページ数)"""
+    conn = get_connection()
+    try:
+        with metrics.timer("vety_db_maintenance_seconds", {"task": f"checkpoint_{mode.lower()}"}):
+            return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+
+def optimize():
+    conn = get_connection()
+    try:
+        with metrics.timer("vety_db_maintenance_seconds", {"task": "optimize"}):
+            conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+
+def incremental_vacuum(pages: int = VACUUM_PAGES) -> int:
+    """空きページを最大 pages 個だけ解放し、解放前の空きページ数を返す（incremental でないDBでは何もしない）"""
+    conn = get_connection()
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            with metrics.timer("vety_db_maintenance_seconds", {"task": "incremental_vacuum"}):
+                conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return free
+    finally:
+        conn.close()
+
+def _due(task: str, interval: float, now: float) -> bool:
+    key = (guilds.partition(), task)
+    if now < _next_run.get(key, 0):
+        return False
+    _next_run[key] = now + interval
+    return True
+
+def run_due():
+    """ティックの書き込みが終わった直後に呼ぶ。期限が来た軽い処理だけを行う"""
+    now = time.monotonic()
+    ran = []
+    try:
+        if _due("checkpoint", CHECKPOINT_INTERVAL, now):
+            busy, wal_pages, done = checkpoint("PASSIVE")
+            ran.append("checkpoint")
+            # WALが大きい時、または定期的に、WALファイル自体を切り詰める
+            if wal_pages > TRUNCATE_WAL_PAGES or _due("truncate", TRUNCATE_INTERVAL, now):
+                busy, _, _ = checkpoint("TRUNCATE")
+                if busy:
+                    metrics.inc("vety_db_checkpoint_busy_total")
+                ran.append("truncate")
+        if _due("vacuum", VACUUM_INTERVAL, now):
+            incremental_vacuum()
+            ran.append("vacuum")
+        if _due("optimize", OPTIMIZE_INTERVAL, now):
+            optimize()
+            ran.append("optimize")
+    except sqlite3.OperationalError as e:
+        # 混雑で取れなければ次の機会に回す
+        print(f"⚠️ DBメンテナンスを見送りました: {e}")
+    return ran
+
+class _TooManyRestarts(Exception):
+    pass
+
+def backup(dest: str | None = None) -> str:
+    """
+    オンラインバックアップ。少しずつコピーしてステップ間でロックを手放す。
+    コピー中の書き込みで何度もやり直しになる場合は、1回の読み取りでまとめてコピーする
+    （WALでは読み取り中も書き込みは止まらない）
+    """
+    if dest is None:
+        os.makedirs(backup_dir(), exist_ok=True)
+        dest = os.path.join(backup_dir(), f"shared-{datetime.now():%Y%m%d-%H%M%S}.db")
+    tmp = dest + ".tmp"
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        state["remaining"] = remaining
+
+    src = get_connection()
+    try:
+        with metrics.timer("vety_db_maintenance_seconds", {"task": "backup"}):
+            dst = sqlite3.connect(tmp)
+            try:
+                try:
+                    src.backup(dst, pages=BACKUP_STEP_PAGES, progress=progress, sleep=BACKUP_STEP_SLEEP)
+                except _TooManyRestarts:
+                    src.backup(dst, pages=-1)
+                # コピー先は1ファイルで完結させる（-wal/-shm を作らない）
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+        os.replace(tmp, dest)  # 書きかけのファイルを残さない
+    finally:
+        src.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    # 古いバックアップを消す
+    if os.path.dirname(dest) == backup_dir():
+        for old in sorted(glob.glob(os.path.join(backup_dir(), "shared-*.db")))[:-BACKUP_KEEP]:
+            os.remove(old)
+    return dest
+
+async def backup_loop():
+    """ボット側で動かす。コピーはスレッドで行いイベントループを止めない"""
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            path = await asyncio.to_thread(backup)
+            print(f"💾 バックアップ完了: {path}")
+        except Exception as e:
+            print(f"❌ バックアップエラー: {e}")
+
+metrics.describe("vety_db_maintenance_seconds", "チェックポイント・バックアップ等のDBメンテナンス時間")
+metrics.describe("vety_db_checkpoint_busy_total", "読み取り中のため完了しなかった TRUNCATE チェックポイントの数")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="DBメンテナンス（ボット停止中に実行する）")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="既存DBを VACUUM で作り直して incremental vacuum を有効にする")
+    parser.add_argument("--guild", help="対象サーバーのID（省略時は shared.db）")
+    args = parser.parse_args()
+    guilds.current_guild.set(args.guild)
+    if args.enable_incremental_vacuum:
+        changed = enable_incremental_vacuum()
+        print("incremental vacuum を有効にしました" if changed else "すでに有効です")
+    else:
+        parser.print_help()
@@ -0,0 +1,57 @@
+import asyncio
+import contextvars
+import os
+
+# 既存の shared.db をそのまま使うサーバー（1サーバー運用からの移行用）
+PRIMARY_GUILD_ID = os.getenv("PRIMARY_GUILD_ID")
+
+# 処理中のサーバーID。コマンドは CommandTree.interaction_check で、
+# 価格ループ等のバックグラウンド処理は create_task(guild_id, ...) で設定する
+current_guild = contextvars.ContextVar("current_guild", default=None)
+
+# サーバーごとのメモリ上の状態 {(partition, name): 値}
+_locals = {}
+_ready_dirs = set()
+
+def partition(guild_id=None) -> str | None:
+    """
+    市場の区切り。None は既存の shared.db（DM・PRIMARY_GUILD_ID のサーバー）。
+    guild_id 省略時は処理中のサーバー
+    """
+    if guild_id is None:
+        guild_id = current_guild.get()
+    if guild_id is None or str(guild_id) == PRIMARY_GUILD_ID:
+        return None
+    return str(guild_id)
+
+def db_path(base_path: str) -> str:
+    """サーバーごとのDBファイル（shared/guilds/<guild_id>/shared.db）。フォルダは初回に作る"""
+    key = partition()
+    if key is None:
+        path = base_path
+    else:
+        path = os.path.join(os.path.dirname(base_path), "guilds", key, os.path.basename(base_path))
+    directory = os.path.dirname(path)
+    if directory not in _ready_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _ready_dirs.add(directory)
+    return path
+
+def local(name: str, factory):
+    """処理中のサーバー用の状態を返す（初回は factory() で作る）"""
+    key = (partition(), name)
+    value = _locals.get(key)
+    if value is None:
+        value = _locals.setdefault(key, factory())
+    return value
+
+def reset(name: str):
+    """全サーバーの name の状態を捨てる"""
+    for key in [k for k in _locals if k[1] == name]:
+        del _locals[key]
+
+def create_task(guild_id, coro_fn, *args) -> asyncio.Task:
+    """guild_id を処理中のサーバーとしてタスクを起動する（タスク内で作るタスク・スレッドにも引き継がれる）"""
+    ctx = contextvars.copy_context()
+    ctx.run(current_guild.set, guild_id)
+    return asyncio.get_running_loop().create_task(coro_fn(*args), context=ctx)
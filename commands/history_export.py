@@ -0,0 +1,117 @@
+import csv
+import gzip
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta
+from commands import stock_manager
+from commands import ledger
+from commands import market_index
+
+# 1回のクエリで読む行数。ページごとに接続を開き直し、読み取りトランザクションを短く保つ
+PAGE_SIZE = 5000
+
+def _parse_date(text: str | None, default: datetime) -> datetime:
+    if not text:
+        return default
+    return datetime.strptime(text.strip(), "%Y-%m-%d")
+
+def date_range(start: str | None, end: str | None, max_days: int = 366):
+    """'YYYY-MM-DD' を [開始, 終了) の文字列に変換する（終了日はその日を含む）"""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end_dt = _parse_date(end, today) + timedelta(days=1)
+    start_dt = _parse_date(start, end_dt - timedelta(days=7))
+    if start_dt >= end_dt:
+        raise ValueError("開始日は終了日より前にしてください")
+    if end_dt - start_dt > timedelta(days=max_days):
+        raise ValueError(f"期間は最大 {max_days} 日です")
+    return start_dt.strftime("%Y-%m-%d %H:%M:%S"), end_dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def iter_price_history(symbol: str, start: str, end: str, page_size: int = PAGE_SIZE):
+    """stock_history を (timestamp, rowid) のキーセットでページングしながら1行ずつ返す"""
+    last_ts, last_rowid = start, 0
+    first = True
+    while True:
+        with stock_manager.get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT rowid, timestamp, price, delta FROM stock_history
+                WHERE symbol = ? AND timestamp < ?
+                  AND (timestamp > ? OR (timestamp = ? AND rowid > ?))
+                ORDER BY timestamp, rowid
+                LIMIT ?
+            """, (symbol, end, last_ts, last_ts, -1 if first else last_rowid, page_size))
+            page = c.fetchall()
+        first = False
+        if not page:
+            return
+        for rowid, ts, price, delta in page:
+            yield ts, symbol, price, delta
+        last_rowid, last_ts = page[-1][0], page[-1][1]
+        if len(page) < page_size:
+            return
+
+def symbol_exists(symbol: str) -> bool:
+    """銘柄か指数（'^' 付き）なら True。指数の価格も stock_history に記録されている"""
+    symbol = symbol.upper()
+    if symbol.startswith(market_index.INDEX_PREFIX):
+        return symbol in market_index.get_index_symbols(symbol, 1000)
+    return stock_manager.get_price(symbol) is not None
+
+def iter_trades(symbol: str, start: str, end: str, page_size: int = PAGE_SIZE):
+    """
+    仕訳から売買・還元を posting_id のキーセットで1行ずつ返す。
+    売買・還元は必ず市場勘定の行を1つ持つので、その行の相手（注文者・還元先）の側から見た金額を出す。
+    指値買いの約定も同じ形で記録される
+    """
+    # 仕訳の ts は ISO 形式（T区切り）なので比較用に揃える
+    start, end = start.replace(" ", "T"), end.replace(" ", "T")
+    last_id = 0
+    while True:
+        with ledger.get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT posting_id, ts, kind, counterparty, qty, price, -amount FROM ledger
+                WHERE symbol = ? AND posting_id > ? AND user_id = ?
+                  AND kind IN (?, ?, ?)
+                  AND ts >= ? AND ts < ?
+                ORDER BY posting_id
+                LIMIT ?
+            """, (symbol, last_id, ledger.MARKET, ledger.BUY, ledger.SELL, ledger.REBATE, start, end, page_size))
+            page = c.fetchall()
+        if not page:
+            return
+        for posting_id, ts, kind, user_id, qty, price, amount in page:
+            yield posting_id, ts, symbol, kind, user_id, qty, price, amount
+        last_id = page[-1][0]
+        if len(page) < page_size:
+            return
+
+EXPORTS = {
+    "prices": (("timestamp", "symbol", "price", "delta"), iter_price_history),
+    "trades": (("posting_id", "ts", "symbol", "kind", "user_id", "qty", "price", "amount"), iter_trades),
+}
+
+def export_csv_gz(kind: str, symbol: str, start: str, end: str, directory: str | None = None) -> tuple[str, int]:
+    """
+    gzip圧縮したCSVファイルへ流し込む。メモリ使用量は PAGE_SIZE 行分で一定。
+    戻り値は (ファイルパス, 行数)。executor から呼ぶこと
+    """
+    header, iterator = EXPORTS[kind]
+    symbol = symbol.upper()
+    # 一時ファイル名に入力値を使わない
+    fd, path = tempfile.mkstemp(prefix="vety_export_", suffix=".csv.gz", dir=directory)
+    os.close(fd)
+    count = 0
+    try:
+        with gzip.open(path, "wb", compresslevel=6) as gz:
+            with io.TextIOWrapper(gz, encoding="utf-8", newline="") as text:
+                writer = csv.writer(text)
+                writer.writerow(header)
+                for row in iterator(symbol, start, end):
+                    writer.writerow(row)
+                    count += 1
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
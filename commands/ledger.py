@@ -0,0 +1,241 @@
+import sqlite3
+import os
+import time
+from datetime import datetime
+from commands import metrics
+from commands import guilds
+
+# 絶対パスに変換
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
+
+DB_PATH = os.path.join(DB_DIR, "shared.db")
+
+def get_connection():
+    return sqlite3.connect(guilds.db_path(DB_PATH), timeout=30, check_same_thread=False, factory=metrics.InstrumentedConnection)
+
+# 仕訳の種類
+ISSUE = "issue"        # 管理者による発行
+BURN = "burn"          # 管理者による減額
+TRANSFER = "transfer"  # ユーザー間送金（送金元・送金先の2行）
+BUY = "buy"            # 株の購入代金（指値買いの拘束を含む）
+SELL = "sell"          # 株の売却代金
+REBATE = "rebate"      # 売却損の銘柄作成者への還元
+REFUND = "refund"      # 指値買いの拘束解除・差額返金
+OPENING = "opening"    # 複式化以前の残高を相手勘定へ振り替えた開始仕訳
+
+# ユーザー以外の相手勘定。仕訳は必ず相手勘定との組で、合計が0になるように追記する
+TREASURY = "treasury"      # 発行・減額の相手
+MARKET = "market"          # 売買代金・還元の相手
+ESCROW_PREFIX = "escrow:"  # 指値買いの拘束（escrow:{order_id}）
+
+def escrow(order_id) -> str:
+    return f"{ESCROW_PREFIX}{order_id}"
+
+def is_system_account(account) -> bool:
+    return account in (TREASURY, MARKET) or str(account or "").startswith(ESCROW_PREFIX)
+
+def entry(kind: str, src: str, dst: str, amount: float, ref=None, currency: str = "VETY") -> list[tuple]:
+    """src から dst へ amount を移す2行の仕訳（post にそのまま渡せる）"""
+    return [
+        (kind, src, currency, -amount, dst, ref),
+        (kind, dst, currency, amount, src, ref),
+    ]
+
+# 何秒ごとに未反映の仕訳を残高スナップショットへ畳み込むか
+COMPACT_INTERVAL = 60
+_last_compact = {}  # {サーバー: 前回の反映時刻}
+
+# 残高 = balances（スナップショット）+ 反映済み位置より後ろの仕訳の合計
+_BALANCE_SQL = """
+    SELECT COALESCE((SELECT balance FROM balances WHERE user_id = ? AND currency = ?), 0)
+         + COALESCE((SELECT SUM(amount) FROM ledger
+                      WHERE user_id = ? AND currency = ?
+                        AND posting_id > (SELECT value FROM ledger_state WHERE key = 'applied_id')), 0)
+"""
+
+def init_ledger():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS balances (
+                user_id TEXT,
+                currency TEXT,
+                balance REAL DEFAULT 0,
+                PRIMARY KEY (user_id, currency)
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                posting_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts TEXT,
+                kind TEXT,
+                user_id TEXT,
+                currency TEXT,
+                amount REAL,
+                counterparty TEXT,
+                ref TEXT
+            )
+        """)
+        # 売買の仕訳には銘柄・数量・単価も残す（約定履歴の出力用）
+        columns = {row[1] for row in c.execute("PRAGMA table_info(ledger)")}
+        for name, decl in (("symbol", "TEXT"), ("qty", "INTEGER"), ("price", "REAL")):
+            if name not in columns:
+                c.execute(f"ALTER TABLE ledger ADD COLUMN {name} {decl}")
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ledger_user
+            ON ledger(user_id, currency, posting_id)
+        """)
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ledger_symbol
+            ON ledger(symbol, posting_id)
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS ledger_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """)
+        c.execute("INSERT OR IGNORE INTO ledger_state(key, value) VALUES ('applied_id', 0)")
+
+        # 以前は送金のたびに行っていた通貨表記ゆれ（vety/VETY）の統合を一度だけ行う
+        c.execute("""
+            SELECT user_id, UPPER(currency) FROM balances
+            WHERE currency IS NOT NULL
+            GROUP BY user_id, UPPER(currency)
+            HAVING COUNT(*) > 1 OR MAX(currency) != UPPER(currency)
+        """)
+        for user_id, currency in c.fetchall():
+            _normalize_balance_row(conn, user_id, currency)
+
+        # 複式化以前の残高（片側だけの仕訳）は、差額を一度だけ発行元へ振り替えて合計を0にする
+        for currency, total in unbalanced(c):
+            post(c, [(OPENING, TREASURY, currency, -total, None, None)], balanced=False)
+        conn.commit()
+
+def _normalize_balance_row(conn, user_id: str, currency: str) -> None:
+    cur = currency.upper()
+    c = conn.cursor()
+    # 大小混在の合計を作る
+    c.execute("""
+        SELECT COALESCE(SUM(balance), 0)
+        FROM balances
+        WHERE user_id = ? AND UPPER(currency) = UPPER(?)
+    """, (user_id, cur))
+    total = c.fetchone()[0] or 0
+
+    # 既存の大小混在行を全部消して、1行だけ入れ直す
+    c.execute("DELETE FROM balances WHERE user_id = ? AND UPPER(currency) = UPPER(?)",
+              (user_id, cur))
+    c.execute("""
+        INSERT INTO balances (user_id, currency, balance)
+        VALUES (?, ?, ?)
+    """, (user_id, cur, total))
+
+def begin(conn):
+    """残高を確認してから書き込む処理は、読む前に書き込みロックを取る"""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+def balance_of(c, user_id: str, currency: str = "VETY") -> float:
+    cur = currency.upper()
+    c.execute(_BALANCE_SQL, (user_id, cur, user_id, cur))
+    return c.fetchone()[0] or 0.0
+
+def unbalanced(c) -> list[tuple[str, float]]:
+    """全口座の残高合計が0でない通貨を (通貨, 合計) で返す。複式の仕訳だけなら空になる"""
+    c.execute("""
+        SELECT currency, SUM(amount) FROM (
+            SELECT currency, balance AS amount FROM balances WHERE currency IS NOT NULL
+            UNION ALL
+            SELECT currency, amount FROM ledger
+            WHERE posting_id > (SELECT value FROM ledger_state WHERE key = 'applied_id')
+        )
+        GROUP BY currency
+        HAVING ABS(SUM(amount)) > 1e-6
+    """)
+    return c.fetchall()
+
+def post(c, postings, balanced: bool = True, trade=None):
+    """
+    仕訳をまとめて追記する（コミットは呼び出し側）。
+    postings: (kind, user_id, amount, counterparty, ref) または currency 付きの6要素タプル。
+    trade: 売買の仕訳なら (銘柄, 数量, 単価)。全行に記録する
+    通貨ごとの合計が0にならない組は ValueError（相手勘定の行を必ず含める）
+    """
+    symbol, qty, price = trade or (None, None, None)
+    ts = datetime.now().isoformat(timespec="seconds")
+    rows = []
+    totals = {}
+    for p in postings:
+        if len(p) == 6:
+            kind, user_id, currency, amount, counterparty, ref = p
+        else:
+            kind, user_id, amount, counterparty, ref = p
+            currency = "VETY"
+        currency = currency.upper()
+        totals[currency] = totals.get(currency, 0.0) + float(amount)
+        rows.append((ts, kind, user_id, currency, float(amount), counterparty, ref, symbol, qty, price))
+    if balanced:
+        for currency, total in totals.items():
+            if abs(total) > 1e-6:
+                raise ValueError(f"仕訳の合計が0になりません（{currency}: {total:+}）")
+    c.executemany("""
+        INSERT INTO ledger (ts, kind, user_id, currency, amount, counterparty, ref, symbol, qty, price)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+def get_balance(user_id: str, currency: str = "VETY") -> float:
+    with get_connection() as conn:
+        return balance_of(conn.cursor(), user_id, currency)
+
+def get_history(user_id: str, limit: int = 10):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT ts, kind, amount, counterparty, ref FROM ledger
+            WHERE user_id = ?
+            ORDER BY posting_id DESC
+            LIMIT ?
+        """, (user_id, limit))
+        return c.fetchall()
+
+def compact():
+    """未反映の仕訳を残高スナップショットへまとめて反映する"""
+    with get_connection() as conn:
+        c = conn.cursor()
+        begin(conn)
+        c.execute("SELECT value FROM ledger_state WHERE key = 'applied_id'")
+        applied = c.fetchone()[0]
+        c.execute("SELECT COALESCE(MAX(posting_id), 0) FROM ledger")
+        upto = c.fetchone()[0]
+        if upto <= applied:
+            conn.rollback()
+            return 0
+
+        c.execute("""
+            INSERT OR IGNORE INTO balances (user_id, currency, balance)
+            SELECT DISTINCT user_id, currency, 0 FROM ledger
+            WHERE posting_id > ? AND posting_id <= ?
+        """, (applied, upto))
+        c.execute("""
+            UPDATE balances
+               SET balance = balance + (
+                   SELECT SUM(amount) FROM ledger l
+                   WHERE l.posting_id > ? AND l.posting_id <= ?
+                     AND l.user_id = balances.user_id AND l.currency = balances.currency)
+             WHERE (user_id, currency) IN (
+                   SELECT user_id, currency FROM ledger
+                   WHERE posting_id > ? AND posting_id <= ?)
+        """, (applied, upto, applied, upto))
+        c.execute("UPDATE ledger_state SET value = ? WHERE key = 'applied_id'", (upto,))
+        conn.commit()
+        return upto - applied
+
+def compact_if_due():
+    key = guilds.partition()
+    now = time.monotonic()
+    if now - _last_compact.get(key, 0.0) < COMPACT_INTERVAL:
+        return 0
+    _last_compact[key] = now
+    return compact()
@@ -0,0 +1,237 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from commands import stock_manager
+from commands import stock_trading
+from commands import order_book
+from commands import ledger
+from commands import metrics
+from commands import db_maintenance
+from commands import guilds
+from commands import profiler
+
+# MARKET_ENGINE=process で価格エンジンを別プロセスで動かす（既定は同一プロセス）
+ENGINE_MODE = os.getenv("MARKET_ENGINE", "inprocess")
+# process でもワーカーはこの数まで。超えたサーバーは同一プロセス（スレッド）で動かす
+MAX_PROCESSES = int(os.getenv("MARKET_ENGINE_MAX_PROCESSES", "4"))
+
+TICK_INTERVAL = 1
+AUTO_SELL_INTERVAL = 30
+HANDSHAKE_TIMEOUT = 30
+
+# --- プロセス間メッセージ（先頭要素が種別の小さなタプル） ---
+# bot → engine
+MSG_STOP = "stop"
+MSG_RELOAD_ORDERS = "reload_orders"  # (MSG_RELOAD_ORDERS, symbol)
+MSG_INVALIDATE = "invalidate"        # (MSG_INVALIDATE, symbols) 銘柄の追加・削除でキャッシュを捨てる
+MSG_PROFILE = "profile"              # (MSG_PROFILE, seconds) エンジン側をサンプリングする
+# engine → bot
+MSG_READY = "ready"
+MSG_TICK = "tick"                    # (MSG_TICK, ts, changes, fills, updates)
+MSG_AUTO_SOLD = "auto_sold"          # (MSG_AUTO_SOLD, user_id, result)
+MSG_PROFILED = "profiled"            # (MSG_PROFILED, profiler.run の戻り値)
+MSG_STOPPED = "stopped"
+
+# --- 1ティック分の市場処理（どちらのモードでも共通） ---
+
+def run_tick():
+    """価格更新・約定・履歴記録・古い履歴の削除を行う"""
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "update"}):
+        changes = stock_manager.random_update_prices()  # 価格を更新
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "match"}):
+        fills = order_book.match_orders(changes)  # 動いた銘柄の指値・逆指値を約定
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "log"}):
+        updates = stock_manager.log_current_prices()  # 通知対象を取得
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "cleanup"}):
+        stock_manager.cleanup_old_history()  # 古い履歴を削除
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "ledger"}):
+        ledger.compact_if_due()  # 仕訳を残高スナップショットへ反映
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "maintenance"}):
+        db_maintenance.run_due()  # 書き込みの直後にチェックポイント等を行う
+    return changes, fills, updates
+
+def due_auto_sells():
+    now = stock_manager.now_dt().isoformat()
+    with stock_trading.get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT user_id, symbol, amount FROM user_stocks
+            WHERE auto_sell_time IS NOT NULL AND auto_sell_time <= ?
+        """, (now,))
+        return c.fetchall()
+
+def run_auto_sell():
+    """期限の来た自動売却を実行し (user_id, result) のリストを返す"""
+    results = []
+    for user_id, symbol, amount in due_auto_sells():
+        try:
+            results.append((user_id, stock_trading.sell_stock(user_id, symbol, amount, auto=True)))
+        except Exception as e:
+            print(f"❌ 自動売却エラー: {e}")
+    return results
+
+# --- ワーカープロセス側 ---
+
+def engine_main(conn, guild_id=None):
+    """別プロセスで動く市場エンジン（1サーバーにつき1つ）。Ctrl+C は親プロセスが受けて MSG_STOP で止める"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    guilds.current_guild.set(guild_id)
+    stock_manager.init_db()
+    ledger.init_ledger()
+    order_book.load_orders()
+    conn.send((MSG_READY, os.getpid()))
+
+    next_tick = time.monotonic()
+    next_auto_sell = next_tick + AUTO_SELL_INTERVAL
+    next_metrics = next_tick
+    # サンプラーはスレッドで動かし、結果はこのスレッドから送る（パイプへの送信を1スレッドに保つ）
+    profiled = queue.SimpleQueue()
+    running = True
+    while running:
+        # 次のティックまでの空き時間で bot からの指示を待つ
+        while conn.poll(max(0.0, next_tick - time.monotonic())):
+            msg = conn.recv()
+            if msg[0] == MSG_STOP:
+                running = False
+                break
+            if msg[0] == MSG_RELOAD_ORDERS:
+                order_book.load_orders(msg[1])
+            elif msg[0] == MSG_INVALIDATE:
+                stock_manager.forget_symbols(msg[1])
+            elif msg[0] == MSG_PROFILE:
+                threading.Thread(target=lambda s=msg[1]: profiled.put(profiler.run(s)),
+                                 name="engine-profiler", daemon=True).start()
+        if not running:
+            break
+
+        try:
+            while not profiled.empty():
+                conn.send((MSG_PROFILED, profiled.get()))
+            with metrics.timer("vety_tick_seconds"):
+                changes, fills, updates = run_tick()
+            conn.send((MSG_TICK, time.time(), changes, fills, updates))
+            if metrics.METRICS_FILE and time.monotonic() >= next_metrics:
+                # ワーカー側の計測は別ファイルに書き出す
+                metrics.write_file(metrics.METRICS_FILE + ".engine")
+                next_metrics = time.monotonic() + 15
+
+            if time.monotonic() >= next_auto_sell:
+                for user_id, result in run_auto_sell():
+                    conn.send((MSG_AUTO_SOLD, user_id, result))
+                next_auto_sell = time.monotonic() + AUTO_SELL_INTERVAL
+        except (BrokenPipeError, EOFError):
+            return
+        except Exception as e:
+            print(f"❌ 市場エンジンエラー: {e}")
+
+        next_tick += TICK_INTERVAL
+        if next_tick < time.monotonic():
+            next_tick = time.monotonic()  # 遅れた分は詰めずに捨てる
+
+    try:
+        conn.send((MSG_STOPPED,))
+    except (BrokenPipeError, OSError):
+        pass
+    conn.close()
+
+# --- bot プロセス側 ---
+
+class EngineProcess:
+    """市場エンジンのワーカープロセスを起動し、届いたメッセージを handler に渡す"""
+
+    def __init__(self, handler, guild_id=None):
+        self.handler = handler  # async def handler(msg)
+        self.guild_id = guild_id
+        self.process = None
+        self.conn = None
+        self._loop = None
+        self._inbox = None
+        self._pump = None
+        self._profile = None  # 実行中のプロファイル結果を待つ Future
+
+    async def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=engine_main, args=(child_conn, self.guild_id),
+                                   name=f"market-engine-{self.guild_id or 'default'}", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        # 起動ハンドシェイク: READY が来るまで待つ
+        self._loop = asyncio.get_running_loop()
+        ready = await self._loop.run_in_executor(None, self.conn.poll, HANDSHAKE_TIMEOUT)
+        if not ready or self.conn.recv()[0] != MSG_READY:
+            self.process.terminate()
+            raise RuntimeError("市場エンジンの起動に失敗しました")
+        # 受信順（ティック順）を保つため、1つのタスクで順番に処理する
+        self._inbox = asyncio.Queue()
+        self._pump = self._loop.create_task(self._run_pump())
+        self._loop.add_reader(self.conn.fileno(), self._on_readable)
+        print(f"市場エンジン起動: guild={self.guild_id or 'default'} pid={self.process.pid}")
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                if msg[0] == MSG_STOPPED:
+                    self._loop.remove_reader(self.conn.fileno())
+                    return
+                if msg[0] == MSG_PROFILED:
+                    if self._profile is not None and not self._profile.done():
+                        self._profile.set_result(msg[1])
+                    continue
+                self._inbox.put_nowait(msg)
+        except (EOFError, OSError):
+            self._loop.remove_reader(self.conn.fileno())
+            print("❌ 市場エンジンとの接続が切れました")
+
+    async def _run_pump(self):
+        guilds.current_guild.set(self.guild_id)  # handler はこのエンジンのサーバーとして呼ぶ
+        while True:
+            msg = await self._inbox.get()
+            try:
+                await self.handler(msg)
+            except Exception as e:
+                print(f"❌ 市場エンジンのメッセージ処理エラー: {e}")
+
+    def reload_orders(self, symbol: str):
+        if self.conn is not None:
+            self.conn.send((MSG_RELOAD_ORDERS, symbol))
+
+    def invalidate(self, symbols: list[str]):
+        if self.conn is not None:
+            self.conn.send((MSG_INVALIDATE, list(symbols)))
+
+    async def profile(self, seconds: float):
+        """ワーカープロセス内をサンプリングする。戻り値は profiler.run と同じ（実行中なら None）"""
+        if self.conn is None or (self._profile is not None and not self._profile.done()):
+            return None
+        self._profile = self._loop.create_future()
+        self.conn.send((MSG_PROFILE, seconds))
+        try:
+            return await asyncio.wait_for(self._profile, profiler.MAX_SECONDS + HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+    async def stop(self, timeout: float = 10):
+        if self.process is None:
+            return
+        try:
+            self.conn.send((MSG_STOP,))
+        except (BrokenPipeError, OSError):
+            pass
+        # STOPPED は _on_readable が受け取る。プロセス終了を待ってから後始末する
+        await self._loop.run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        try:
+            self._loop.remove_reader(self.conn.fileno())
+        except Exception:
+            pass
+        self.conn.close()
+        self._pump.cancel()
+        self.process = None
@@ -0,0 +1,306 @@
+import os
+import re
+import sqlite3
+from commands import metrics
+from commands import guilds
+
+# 絶対パスに変換
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
+
+DB_PATH = os.path.join(DB_DIR, "shared.db")
+
+def get_connection():
+    return sqlite3.connect(guilds.db_path(DB_PATH), timeout=10, factory=metrics.InstrumentedConnection)
+
+# 指数は stock_history に "^名前" の銘柄として記録する（/株価 でそのまま描ける）
+INDEX_PREFIX = "^"
+MARKET = "MARKET"      # 全銘柄の価格加重指数
+BASE_LEVEL = 1000.0    # 作成時の指数値
+
+# 加重方式
+PRICE_WEIGHTED = "price"  # 価格の単純合計
+CAP_WEIGHTED = "cap"      # 価格 × 株数（sector_members.shares）
+
+WEIGHTING_LABELS = {
+    PRICE_WEIGHTED: "価格加重",
+    CAP_WEIGHTED: "時価総額加重",
+}
+
+_NAME_RE = re.compile(r"^[A-Z0-9_]{1,16}$")
+
+def index_symbol(name: str) -> str:
+    return INDEX_PREFIX + name
+
+def init_tables(c):
+    """stock_manager.init_db から呼ぶ"""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sectors (
+            name TEXT PRIMARY KEY,
+            weighting TEXT DEFAULT 'price',
+            divisor REAL DEFAULT 0,
+            open_day TEXT,
+            open_level REAL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sector_members (
+            sector TEXT,
+            symbol TEXT,
+            shares INTEGER DEFAULT 1,
+            PRIMARY KEY (sector, symbol)
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sector_members_symbol
+        ON sector_members(symbol)
+    """)
+    # 構成が変わるたびに増やす。ティック側はこれを見て読み直す（別プロセスのエンジンにも伝わる）
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS market_index_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO market_index_state(key, value) VALUES ('version', 0)")
+    c.execute("INSERT OR IGNORE INTO sectors(name, weighting) VALUES (?, ?)", (MARKET, PRICE_WEIGHTED))
+
+# --- 構成の変更（除数を調整して指数値が飛ばないようにする） ---
+
+def aggregates(c) -> dict:
+    """各指数の Σ(重み × 価格)。構成を変える前後で呼ぶ"""
+    c.execute("SELECT TOTAL(price) FROM stocks")
+    result = {MARKET: c.fetchone()[0]}
+    c.execute("""
+        SELECT m.sector,
+               TOTAL(CASE WHEN s.weighting = ? THEN st.price * m.shares ELSE st.price END)
+        FROM sector_members m
+        JOIN sectors s ON s.name = m.sector
+        JOIN stocks st ON st.symbol = m.symbol
+        GROUP BY m.sector
+    """, (CAP_WEIGHTED,))
+    result.update(c.fetchall())
+    return result
+
+def rebalance(c, before: dict):
+    """
+    構成変更の後（コミット前）に呼ぶ。変更前の合計 before と今の合計から除数を調整し、
+    指数値を変えずに構成だけを入れ替える
+    """
+    after = aggregates(c)
+    c.execute("SELECT name, divisor FROM sectors")
+    for name, divisor in c.fetchall():
+        old, new = before.get(name, 0), after.get(name, 0)
+        if old > 0 and divisor:
+            divisor = divisor * new / old
+        elif new > 0:
+            divisor = new / BASE_LEVEL  # 空だった指数に初めて銘柄が入った
+        c.execute("UPDATE sectors SET divisor = ? WHERE name = ?", (divisor, name))
+    c.execute("UPDATE market_index_state SET value = value + 1 WHERE key = 'version'")
+
+def normalize_name(name: str) -> str | None:
+    name = (name or "").strip().upper().lstrip(INDEX_PREFIX)
+    if not _NAME_RE.match(name) or name == MARKET:
+        return None
+    return name
+
+def create_sector(name: str, weighting: str = PRICE_WEIGHTED) -> str:
+    sector = normalize_name(name)
+    if sector is None:
+        return "❌ セクター名は英数字と _ の16文字以内で指定してください（MARKET は使えません）。"
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM sectors WHERE name = ?", (sector,))
+        if c.fetchone():
+            return f"❌ セクター `{sector}` は既にあります。"
+        c.execute("INSERT INTO sectors(name, weighting) VALUES (?, ?)", (sector, weighting))
+        c.execute("UPDATE market_index_state SET value = value + 1 WHERE key = 'version'")
+        conn.commit()
+    return f"✅ セクター `{sector}`（{WEIGHTING_LABELS[weighting]}）を作成しました。指数は `{index_symbol(sector)}` です。"
+
+def parse_members(text: str):
+    """'ABC, DEF:500' → [(symbol, shares)]。株数は時価総額加重の時だけ使う"""
+    members = {}
+    for item in text.replace("、", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        symbol, _, shares = item.partition(":")
+        shares = int(shares) if shares.strip() else 1
+        if shares <= 0:
+            raise ValueError(f"{symbol.strip().upper()} の株数は正の数にしてください")
+        members[symbol.strip().upper()] = shares
+    return list(members.items())
+
+def set_members(name: str, members: list[tuple[str, int]]) -> str:
+    """セクターの構成銘柄を入れ替える"""
+    sector = normalize_name(name)
+    if not members:
+        return "❌ 構成銘柄を1つ以上指定してください。"
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM sectors WHERE name = ?", (sector,))
+        if sector is None or not c.fetchone():
+            return f"❌ セクター `{name}` が見つかりません。"
+        c.execute(f"""
+            SELECT symbol FROM stocks WHERE symbol IN ({",".join("?" for _ in members)})
+        """, [symbol for symbol, _ in members])
+        known = {row[0] for row in c.fetchall()}
+        unknown = [symbol for symbol, _ in members if symbol not in known]
+        if unknown:
+            return f"❌ 存在しない銘柄があります: {', '.join(unknown)}"
+
+        before = aggregates(c)
+        c.execute("DELETE FROM sector_members WHERE sector = ?", (sector,))
+        c.executemany("INSERT INTO sector_members(sector, symbol, shares) VALUES (?, ?, ?)",
+                      [(sector, symbol, shares) for symbol, shares in members])
+        rebalance(c, before)
+        conn.commit()
+    return f"✅ セクター `{sector}` の構成を {len(members)} 銘柄に更新しました。"
+
+def delete_sector(name: str) -> str:
+    sector = normalize_name(name)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM sectors WHERE name = ?", (sector,))
+        if sector is None or c.rowcount == 0:
+            return f"❌ セクター `{name}` が見つかりません。"
+        c.execute("DELETE FROM sector_members WHERE sector = ?", (sector,))
+        c.execute("DELETE FROM stock_history WHERE symbol = ?", (index_symbol(sector),))
+        c.execute("UPDATE market_index_state SET value = value + 1 WHERE key = 'version'")
+        conn.commit()
+    return f"🗑️ セクター `{sector}` を削除しました。"
+
+# --- ティックごとの更新 ---
+
+class _IndexState:
+    """サーバーごとの指数の集計値"""
+
+    def __init__(self):
+        self.version = None
+        self.members = {}   # {symbol: [(指数名, 重み), ...]}
+        self.prices = {}    # 集計に含めた時点の各銘柄の価格
+        self.sums = {}      # {指数名: Σ(重み × 価格)}
+        self.divisors = {}  # {指数名: 除数}
+        self.levels = {}    # {指数名: 最後に記録した指数値}
+        self.opens = {}     # {指数名: (日付, 始値)}
+
+def _state() -> _IndexState:
+    return guilds.local("market_index", _IndexState)
+
+def reset_state():
+    guilds.reset("market_index")
+
+def _load(c, state: _IndexState, version: int):
+    """構成が変わった時だけDBから組み直す"""
+    state.version = version
+    state.members, state.sums = {}, {}
+    c.execute("SELECT name, divisor, open_day, open_level FROM sectors")
+    rows = c.fetchall()
+    state.divisors = {name: divisor for name, divisor, _, _ in rows}
+    state.opens = {name: (day, level) for name, _, day, level in rows}
+
+    c.execute("SELECT symbol, price FROM stocks")
+    state.prices = dict(c.fetchall())
+    for symbol in state.prices:
+        state.members[symbol] = [(MARKET, 1)]
+    c.execute("""
+        SELECT m.sector, m.symbol, CASE WHEN s.weighting = ? THEN m.shares ELSE 1 END
+        FROM sector_members m JOIN sectors s ON s.name = m.sector
+    """, (CAP_WEIGHTED,))
+    for sector, symbol, weight in c.fetchall():
+        if symbol in state.prices:
+            state.members[symbol].append((sector, weight))
+
+    for symbol, price in state.prices.items():
+        for name, weight in state.members[symbol]:
+            state.sums[name] = state.sums.get(name, 0) + weight * price
+
+    # 除数のない指数（構成変更を経ずに銘柄が入った既存DBなど）は今の合計を基準値にする
+    for name, total in state.sums.items():
+        if not state.divisors.get(name) and total > 0:
+            state.divisors[name] = total / BASE_LEVEL
+            c.execute("UPDATE sectors SET divisor = ? WHERE name = ?", (state.divisors[name], name))
+
+    # 差分（前回比）用に最後に記録した値を引いておく
+    state.levels = {}
+    for name in state.divisors:
+        c.execute("""SELECT price FROM stock_history
+                     WHERE symbol = ? ORDER BY timestamp DESC LIMIT 1""", (index_symbol(name),))
+        row = c.fetchone()
+        if row:
+            state.levels[name] = row[0]
+
+def apply(c, logged, now) -> list[tuple[str, float]]:
+    """
+    log_current_prices から同じトランザクション内で呼ぶ。
+    logged: 今回記録した (symbol, 価格)。1銘柄あたり所属する指数の数だけの O(1) 更新で済ませ、
+    値が変わった指数を stock_history に書いて (指数銘柄, 指数値) を返す
+    """
+    state = _state()
+    c.execute("SELECT value FROM market_index_state WHERE key = 'version'")
+    row = c.fetchone()
+    if row is None:
+        return []
+    if row[0] != state.version:
+        _load(c, state, row[0])
+
+    touched = set()
+    for symbol, price in logged:
+        old = state.prices.get(symbol)
+        if old is None or old == price:
+            continue
+        state.prices[symbol] = price
+        for name, weight in state.members.get(symbol, ()):
+            state.sums[name] += weight * (price - old)
+            touched.add(name)
+
+    written = []
+    today = now.date().isoformat()
+    for name in touched:
+        divisor = state.divisors.get(name)
+        if not divisor:
+            continue
+        level = round(state.sums[name] / divisor, 2)
+        prev = state.levels.get(name)
+        if prev == level:
+            continue
+        c.execute("""
+            INSERT INTO stock_history (symbol, timestamp, price, delta)
+            VALUES (?, ?, ?, ?)
+        """, (index_symbol(name), now, level, round(level - prev, 2) if prev is not None else 0))
+        state.levels[name] = level
+        # 日が変わって最初の値をその日の基準にする（騰落率の表示用）
+        day, _ = state.opens.get(name, (None, None))
+        if day != today:
+            base = prev if prev is not None else level
+            state.opens[name] = (today, base)
+            c.execute("UPDATE sectors SET open_day = ?, open_level = ? WHERE name = ?", (today, base, name))
+        written.append((index_symbol(name), level))
+    return written
+
+# --- 表示用（集計はせず、記録済みの値を読むだけ） ---
+
+def get_indexes():
+    """[(指数銘柄, 加重方式, 現在値, 当日始値)]。MARKET が先頭"""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT name, weighting, open_level,
+                   (SELECT price FROM stock_history h
+                     WHERE h.symbol = ? || sectors.name
+                     ORDER BY h.timestamp DESC LIMIT 1)
+            FROM sectors
+            ORDER BY name != ?, name
+        """, (INDEX_PREFIX, MARKET))
+        return [(index_symbol(name), weighting, level, open_level)
+                for name, weighting, open_level, level in c.fetchall()]
+
+def get_index_symbols(prefix: str = "", limit: int = 25) -> list[str]:
+    """候補表示用。'^' を付けずに入力しても前方一致する"""
+    prefix = (prefix or "").upper().lstrip(INDEX_PREFIX)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sectors WHERE name LIKE ? ORDER BY name != ?, name LIMIT ?",
+                  (f"{prefix}%", MARKET, limit))
+        return [index_symbol(row[0]) for row in c.fetchall()]
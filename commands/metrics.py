@@ -0,0 +1,255 @@
+import asyncio
+import bisect
+import functools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# 秒単位のヒストグラム境界（1ms〜10s）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# これより長くかかったSQLはロック待ちが発生したとみなす
+LOCK_WAIT_THRESHOLD = 0.05
+
+# METRICS_FILE を指定すると定期的に Prometheus 形式で書き出す
+METRICS_FILE = os.getenv("METRICS_FILE")
+# METRICS_PORT を指定すると 127.0.0.1 で /metrics を公開する
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+_lock = threading.Lock()  # executor スレッドからも記録される
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            self.counts[i] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q: float):
+        """バケット境界で近似したパーセンタイル"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+_histograms = {}  # {(name, labels): Histogram}
+_counters = {}    # {(name, labels): float}
+_help = {}
+
+def _key(name: str, labels: dict | None):
+    return name, tuple(sorted((labels or {}).items()))
+
+def describe(name: str, text: str):
+    _help[name] = text
+
+def observe(name: str, value: float, labels: dict | None = None):
+    key = _key(name, labels)
+    hist = _histograms.get(key)
+    if hist is None:
+        with _lock:
+            hist = _histograms.setdefault(key, Histogram())
+    hist.observe(value)
+
+def inc(name: str, amount: float = 1, labels: dict | None = None):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+@contextmanager
+def timer(name: str, labels: dict | None = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+# --- SQLite の計測 ---
+
+def _statement_kind(sql: str) -> str:
+    word = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "OTHER"
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "BEGIN", "PRAGMA") else "OTHER"
+
+def _timed(method, sql, *args):
+    start = time.perf_counter()
+    try:
+        return method(sql, *args)
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e) or "busy" in str(e):
+            inc("vety_sqlite_lock_timeouts_total")
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("vety_sqlite_statement_seconds", elapsed, {"kind": _statement_kind(sql)})
+        if elapsed >= LOCK_WAIT_THRESHOLD:
+            inc("vety_sqlite_slow_statements_total")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        return _timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return _timed(super().executemany, sql, *args)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=InstrumentedConnection) で文ごとの時間を記録する"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def commit(self):
+        with timer("vety_sqlite_commit_seconds"):
+            super().commit()
+
+    def __exit__(self, exc_type, exc, tb):
+        # with 文の自動コミットも計測する
+        with timer("vety_sqlite_commit_seconds"):
+            return super().__exit__(exc_type, exc, tb)
+
+# --- イベントループの遅延 ---
+
+async def monitor_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        observe("vety_event_loop_lag_seconds", max(0.0, loop.time() - start - interval))
+
+# --- 出力 ---
+
+def _fmt_labels(labels, extra=None) -> str:
+    items = list(labels) + list(extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render() -> str:
+    """Prometheus のテキスト形式"""
+    lines = []
+    with _lock:
+        hists = [(k, h.buckets, list(h.counts), h.total, h.count) for k, h in _histograms.items()]
+        counters = list(_counters.items())
+
+    declared = set()
+    for (name, labels), buckets, counts, total, count in sorted(hists):
+        if name not in declared:
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {total}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {count}")
+
+    for (name, labels), value in sorted(counters):
+        if name not in declared:
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            declared.add(name)
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def summary() -> str:
+    """管理者コマンド向けの短い要約"""
+    with _lock:
+        hists = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+    if not hists and not counters:
+        return "まだ計測データがありません。"
+
+    lines = []
+    for (name, labels), h in hists:
+        if not h.count:
+            continue
+        label = ",".join(f"{k}={v}" for k, v in labels)
+        p50, p99 = h.quantile(0.5), h.quantile(0.99)
+        lines.append(
+            f"`{name.removeprefix('vety_')}{'{' + label + '}' if label else ''}` "
+            f"n={h.count} avg={h.total / h.count * 1000:.1f}ms p50≤{p50 * 1000:.0f}ms p99≤{p99 * 1000:.0f}ms"
+        )
+    for (name, labels), value in counters:
+        label = ",".join(f"{k}={v}" for k, v in labels)
+        lines.append(f"`{name.removeprefix('vety_')}{'{' + label + '}' if label else ''}` {value:g}")
+    return "\n".join(lines)
+
+async def write_file_loop(path: str, interval: float = 15):
+    while True:
+        await asyncio.sleep(interval)
+        write_file(path)
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_exporters():
+    """環境変数で指定された出力先を起動する"""
+    tasks = [asyncio.create_task(monitor_loop_lag())]
+    if METRICS_FILE:
+        tasks.append(asyncio.create_task(write_file_loop(METRICS_FILE)))
+    if METRICS_PORT:
+        await asyncio.start_server(_handle_http, "127.0.0.1", int(METRICS_PORT))
+        print(f"メトリクス公開: http://127.0.0.1:{METRICS_PORT}/metrics")
+    return tasks
+
+describe("vety_tick_seconds", "price_update_loop の1ティックにかかった時間")
+describe("vety_tick_stage_seconds", "ティック内の各段階にかかった時間")
+describe("vety_command_seconds", "スラッシュコマンドの処理時間")
+describe("vety_sqlite_statement_seconds", "SQLite 文の実行時間")
+describe("vety_sqlite_commit_seconds", "SQLite のコミット時間")
+describe("vety_sqlite_lock_timeouts_total", "database is locked で失敗した文の数")
+describe("vety_sqlite_slow_statements_total", "ロック待ちとみなした遅い文の数")
+describe("vety_event_loop_lag_seconds", "イベントループの遅延")
+
+def write_file(path: str):
+    text = render()
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)  # 読み手が書きかけを見ないように置き換える
+
+def timed_command(func):
+    """スラッシュコマンドの処理時間を記録するデコレータ（@tree.command の内側に付ける）"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            observe("vety_command_seconds", time.perf_counter() - start, {"command": func.__name__})
+    return wrapper
@@ -0,0 +1,360 @@
+import heapq
+import threading
+from datetime import datetime
+from commands import stock_trading
+from commands import ledger
+from commands import guilds
+
+# 注文種別
+LIMIT_BUY = "limit_buy"    # 指値買い: 価格 <= 指値 で約定
+LIMIT_SELL = "limit_sell"  # 指値売り: 価格 >= 指値 で約定
+STOP_LOSS = "stop_loss"    # 逆指値売り: 価格 <= 逆指値 で約定
+ORDER_SIDES = (LIMIT_BUY, LIMIT_SELL, STOP_LOSS)
+
+SIDE_LABELS = {
+    LIMIT_BUY: "指値買い",
+    LIMIT_SELL: "指値売り",
+    STOP_LOSS: "逆指値売り",
+}
+
+class _OrderState:
+    """サーバーごとの板"""
+
+    def __init__(self):
+        # 銘柄ごとの板 {symbol: {side: heap}}
+        # heap の要素は (並び順キー, order_id, 注文dict)。先頭が最初に約定する注文になる
+        self.books = {}
+        # 取消済みIDは板から即削除せず、取り出し時に読み飛ばす
+        self.cancelled = set()
+        # 同一プロセスのティックはスレッドで照合するので、コマンド側の変更と排他する
+        self.lock = threading.RLock()
+        # 板を別プロセスの市場エンジンが持つ時は、このプロセスには板を作らない
+        self.remote = False
+
+def _state() -> _OrderState:
+    return guilds.local("order_book", _OrderState)
+
+def get_connection():
+    return stock_trading.get_connection()
+
+def init_orders_table():
+    with get_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stock_orders (
+                order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                symbol TEXT,
+                side TEXT,
+                amount INTEGER,
+                limit_price INTEGER,
+                reserved INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'open',
+                created_at TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_stock_orders_open
+            ON stock_orders(status, symbol)
+        """)
+
+def _sort_key(side: str, limit_price: int) -> int:
+    # 買い・逆指値は高い指値から、売りは安い指値から約定する
+    return limit_price if side == LIMIT_SELL else -limit_price
+
+def _crosses(side: str, limit_price: int, price: int) -> bool:
+    if side == LIMIT_SELL:
+        return price >= limit_price
+    return price <= limit_price
+
+def use_remote_book():
+    """そのサーバーの板は市場エンジンのプロセスが持つ（bot 側は注文をDBに書くだけにする）"""
+    state = _state()
+    with state.lock:
+        state.remote = True
+        state.books.clear()
+        state.cancelled.clear()
+
+def _push(order: dict):
+    state = _state()
+    if state.remote:
+        return
+    with state.lock:
+        book = state.books.setdefault(order["symbol"], {side: [] for side in ORDER_SIDES})
+        key = _sort_key(order["side"], order["limit_price"])
+        heapq.heappush(book[order["side"]], (key, order["order_id"], order))
+
+def load_orders(symbol: str | None = None):
+    """DBの未約定注文から板を組み直す（symbol 指定時はその銘柄だけ）"""
+    init_orders_table()
+    if _state().remote:
+        return
+    if symbol is None:
+        where, params = "status = 'open'", ()
+    else:
+        symbol = symbol.upper()
+        where, params = "status = 'open' AND symbol = ?", (symbol,)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT order_id, user_id, symbol, side, amount, limit_price, reserved
+            FROM stock_orders WHERE {where}
+        """, params)
+        rows = c.fetchall()
+
+    state = _state()
+    with state.lock:
+        if symbol is None:
+            state.books.clear()
+            state.cancelled.clear()
+        else:
+            state.books.pop(symbol, None)
+        for order_id, user_id, symbol, side, amount, limit_price, reserved in rows:
+            _push({
+                "order_id": order_id,
+                "user_id": user_id,
+                "symbol": symbol,
+                "side": side,
+                "amount": amount,
+                "limit_price": limit_price,
+                "reserved": reserved or 0,
+            })
+
+def place_order(user_id: str, symbol: str, side: str, amount: int, limit_price: int) -> str:
+    symbol = symbol.upper()
+    if side not in ORDER_SIDES:
+        return "注文種別が不正です。"
+    if amount <= 0:
+        return "注文数は1以上を指定してください。"
+    if limit_price <= 0:
+        return "指値は1以上を指定してください。"
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT price FROM stocks WHERE symbol = ?", (symbol,))
+        if c.fetchone() is None:
+            return "銘柄が存在しません"
+
+        reserved = 0
+        if side == LIMIT_BUY:
+            # 指値買いは注文時に最大代金を拘束しておく
+            reserved = int(round(limit_price * amount))
+            ledger.begin(conn)
+            if ledger.balance_of(c, user_id) < reserved:
+                conn.rollback()
+                return f"残高不足（必要: {reserved} Vety）"
+        else:
+            c.execute("""
+                SELECT COALESCE(SUM(amount), 0) FROM user_stocks
+                WHERE user_id = ? AND symbol = ? AND auto_sell_time IS NULL
+            """, (user_id, symbol))
+            owned = c.fetchone()[0] or 0
+            if owned < amount:
+                return f"保有数が不足しています（保有: {owned} < 要求: {amount}）"
+
+        c.execute("""
+            INSERT INTO stock_orders
+            (user_id, symbol, side, amount, limit_price, reserved, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'open', ?)
+        """, (user_id, symbol, side, amount, limit_price, reserved, datetime.now().isoformat()))
+        order_id = c.lastrowid
+        if reserved:
+            ledger.post(c, ledger.entry(ledger.BUY, user_id, ledger.escrow(order_id), reserved, f"order:{order_id}"))
+        conn.commit()
+
+    _push({
+        "order_id": order_id,
+        "user_id": user_id,
+        "symbol": symbol,
+        "side": side,
+        "amount": amount,
+        "limit_price": limit_price,
+        "reserved": reserved,
+    })
+    return f"注文 #{order_id}: {symbol} を {limit_price}Vety で{amount}口 {SIDE_LABELS[side]}注文しました。"
+
+def cancel_order(user_id: str, order_id: int) -> str:
+    with get_connection() as conn:
+        c = conn.cursor()
+        # 約定処理と競合しないよう、読む前に書き込みロックを取る
+        ledger.begin(conn)
+        c.execute("""
+            SELECT side, reserved FROM stock_orders
+            WHERE order_id = ? AND user_id = ? AND status = 'open'
+        """, (order_id, user_id))
+        row = c.fetchone()
+        if row is None:
+            conn.rollback()
+            return f"取消できる注文 #{order_id} が見つかりません。"
+        side, reserved = row
+
+        c.execute("UPDATE stock_orders SET status = 'cancelled' WHERE order_id = ? AND status = 'open'", (order_id,))
+        if c.rowcount != 1:
+            conn.rollback()
+            return f"取消できる注文 #{order_id} が見つかりません。"
+        if side == LIMIT_BUY and reserved:
+            ledger.post(c, ledger.entry(ledger.REFUND, ledger.escrow(order_id), user_id, reserved, f"order:{order_id}"))
+        conn.commit()
+
+    state = _state()
+    if not state.remote:
+        with state.lock:
+            state.cancelled.add(order_id)
+    return f"注文 #{order_id} を取り消しました。"
+
+def cancel_symbol_orders(c, symbol: str) -> int:
+    """
+    銘柄削除時に、その銘柄の未約定注文をすべて取り消して拘束分を返金し、板からも外す。
+    コミットは呼び出し側（銘柄の削除と同じトランザクションで行う）
+    """
+    symbol = symbol.upper()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stock_orders'")
+    if c.fetchone() is not None:
+        c.execute("""
+            SELECT order_id, user_id, side, reserved FROM stock_orders
+            WHERE symbol = ? AND status = 'open'
+        """, (symbol,))
+        rows = c.fetchall()
+        c.execute("UPDATE stock_orders SET status = 'cancelled' WHERE symbol = ? AND status = 'open'", (symbol,))
+        refunds = [
+            posting
+            for order_id, user_id, side, reserved in rows
+            if side == LIMIT_BUY and reserved
+            for posting in ledger.entry(ledger.REFUND, ledger.escrow(order_id), user_id, reserved, f"order:{order_id}")
+        ]
+        if refunds:
+            ledger.post(c, refunds)
+    else:
+        rows = []
+
+    state = _state()
+    with state.lock:
+        for heap in state.books.pop(symbol, {}).values():
+            for _, order_id, _order in heap:
+                state.cancelled.discard(order_id)
+    return len(rows)
+
+def get_user_orders(user_id: str):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT order_id, symbol, side, amount, limit_price FROM stock_orders
+            WHERE user_id = ? AND status = 'open'
+            ORDER BY order_id ASC
+        """, (user_id,))
+        return c.fetchall()
+
+def _pop_crossed(symbol: str, price: int) -> list[dict]:
+    """板の先頭から約定条件を満たす注文だけを取り出す（O(約定数 × log n)）"""
+    state = _state()
+    crossed = []
+    with state.lock:
+        book = state.books.get(symbol)
+        if not book:
+            return []
+        for side, heap in book.items():
+            while heap:
+                _, order_id, order = heap[0]
+                if order_id in state.cancelled:
+                    heapq.heappop(heap)
+                    state.cancelled.discard(order_id)
+                    continue
+                if not _crosses(side, order["limit_price"], price):
+                    break
+                heapq.heappop(heap)
+                crossed.append(order)
+        if not any(book.values()):
+            del state.books[symbol]
+    # 注文順（古い順）に約定させる
+    crossed.sort(key=lambda o: o["order_id"])
+    return crossed
+
+def _fill_buy(c, order: dict, price: int) -> dict:
+    cost = int(round(price * order["amount"]))
+    stock_trading._insert_lot(c, order["user_id"], order["symbol"], order["amount"], price, None)
+    # 拘束分から代金を支払い、残りを返金する。市場側の行の相手は注文者にする（約定履歴の出力用）
+    escrow, ref = ledger.escrow(order["order_id"]), f"order:{order['order_id']}"
+    ledger.post(c, [
+        (ledger.BUY, escrow, -cost, ledger.MARKET, ref),
+        (ledger.BUY, ledger.MARKET, cost, order["user_id"], ref),
+    ], trade=(order["symbol"], order["amount"], price))
+    refund = order["reserved"] - cost
+    if refund > 0:
+        ledger.post(c, ledger.entry(ledger.REFUND, escrow, order["user_id"], refund, ref))
+    return {
+        "ok": True,
+        "message": f"{order['symbol']} を 1口 {price}Vetyで{order['amount']}口 購入しました（合計{cost}Vety）",
+        "symbol": order["symbol"],
+        "amount": order["amount"],
+        "unit_price": price,
+        "total": cost,
+        "profit_loss": None,
+    }
+
+def _fill(c, order: dict, price: int) -> dict | None:
+    # 取消と競合した注文は約定させない
+    c.execute("""
+        UPDATE stock_orders SET status = 'filling'
+        WHERE order_id = ? AND status = 'open'
+    """, (order["order_id"],))
+    if c.rowcount != 1:
+        return None
+
+    if order["side"] == LIMIT_BUY:
+        result = _fill_buy(c, order, price)
+    else:
+        result = stock_trading._sell_lots(
+            c, order["user_id"], order["symbol"], order["amount"], False, price
+        )
+
+    if result["ok"]:
+        status = "filled"
+    else:
+        status = "failed"
+    c.execute("UPDATE stock_orders SET status = ? WHERE order_id = ?", (status, order["order_id"]))
+
+    result["order_id"] = order["order_id"]
+    result["side"] = order["side"]
+    result["user_id"] = order["user_id"]
+    return result
+
+def match_orders(changes) -> list[dict]:
+    """
+    価格ティックで動いた銘柄の板だけを照合し、約定分を1トランザクションで決済する。
+    changes: random_update_prices() が返す (symbol, 旧価格, 新価格) のリスト
+    決済できなかった注文は板に戻し、次のティックで照合し直す
+    """
+    crossed = []
+    for symbol, _old_price, new_price in changes:
+        for order in _pop_crossed(symbol, new_price):
+            crossed.append((order, new_price))
+
+    if not crossed:
+        return []
+
+    fills = []
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            ledger.begin(conn)
+            for order, price in crossed:
+                # 1注文ごとにセーブポイントを切り、例外が出た注文だけ巻き戻す
+                c.execute("SAVEPOINT fill")
+                try:
+                    result = _fill(c, order, price)
+                except Exception as e:
+                    c.execute("ROLLBACK TO fill")
+                    c.execute("RELEASE fill")
+                    _push(order)
+                    print(f"❌ 注文 #{order['order_id']} の約定エラー: {e}")
+                    continue
+                c.execute("RELEASE fill")
+                if result is not None:
+                    fills.append(result)
+            conn.commit()
+        except Exception:
+            # コミットできなければ全注文が未約定のまま。取り出した注文を板に戻す
+            conn.rollback()
+            for order, _price in crossed:
+                _push(order)
+            raise
+    return fills
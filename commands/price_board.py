@@ -0,0 +1,144 @@
+import discord
+from datetime import date
+from commands import stock_manager
+from commands import guilds
+
+# 1ページあたりの銘柄数（Embedの説明文上限 4096 文字に十分収まる）
+PAGE_SIZE = 20
+
+SORT_LABELS = {
+    "symbol": "銘柄名順",
+    "change": "騰落率順",
+    "volume": "出来高順",
+}
+
+class _Board:
+    """サーバーごとの価格一覧"""
+
+    def __init__(self):
+        # 最新のスナップショット {sort_key: [ページ文字列, ...]}
+        self.pages = {key: [] for key in SORT_LABELS}
+        self.dirty = True
+        # tickバスから受け取った最新価格（DBは起動時と銘柄の増減時だけ読む）
+        self.prices = {}
+        self.reload = True
+        # 当日の基準価格と出来高（メモリ上のみ）
+        self.day = None
+        self.open_prices = {}
+        self.volumes = {}
+
+def _board() -> _Board:
+    return guilds.local("price_board", _Board)
+
+def invalidate():
+    """銘柄の追加・削除などで次のティックにDBから読み直させる"""
+    _board().reload = True
+
+def record_volume(symbol: str, amount: int):
+    if amount <= 0:
+        return
+    board = _board()
+    _roll_day(board)
+    board.volumes[symbol] = board.volumes.get(symbol, 0) + amount
+    board.dirty = True
+
+def _roll_day(board: _Board):
+    today = date.today()
+    if board.day != today:
+        board.day = today
+        board.open_prices.clear()
+        board.volumes.clear()
+
+def _format_row(symbol: str, price: int, change_pct: float, volume: int) -> str:
+    return f"`{symbol:<8}` {price:>8.0f} Vety  {change_pct:+6.2f}%  出来高 {volume}"
+
+def _build_pages(lines: list[str]) -> list[str]:
+    if not lines:
+        return ["📉 現在、登録されている銘柄がありません。"]
+    return ["\n".join(lines[i:i + PAGE_SIZE]) for i in range(0, len(lines), PAGE_SIZE)]
+
+def _rebuild(board: _Board):
+    _roll_day(board)
+    entries = []
+    for symbol, price in board.prices.items():
+        open_price = board.open_prices.setdefault(symbol, price)
+        change_pct = (price - open_price) / open_price * 100 if open_price else 0.0
+        entries.append((symbol, price, change_pct, board.volumes.get(symbol, 0)))
+
+    orders = {
+        "symbol": sorted(entries, key=lambda e: e[0]),
+        "change": sorted(entries, key=lambda e: e[2], reverse=True),
+        "volume": sorted(entries, key=lambda e: e[3], reverse=True),
+    }
+    # 参照の差し替えだけで公開するので閲覧側はロック不要
+    board.pages = {key: _build_pages([_format_row(*e) for e in ordered]) for key, ordered in orders.items()}
+    board.dirty = False
+
+def refresh():
+    """DBから全銘柄を読み直して作り直す（起動時・銘柄の増減時のみ）"""
+    board = _board()
+    board.prices.clear()
+    board.prices.update(stock_manager.get_all_prices())
+    board.reload = False
+    _rebuild(board)
+
+async def on_tick(batch):
+    """tickバスの購読者。1ティックに最大1回だけ作り直す"""
+    board = _board()
+    if board.reload:
+        refresh()
+        return
+    for event in batch:
+        board.prices[event.symbol] = event.new_price
+    if batch or board.dirty:
+        _rebuild(board)
+
+def page_count(sort_key: str) -> int:
+    return len(_board().pages.get(sort_key) or [""])
+
+def build_embed(sort_key: str, page: int) -> discord.Embed:
+    pages = _board().pages.get(sort_key) or ["📉 現在、登録されている銘柄がありません。"]
+    page = max(0, min(page, len(pages) - 1))
+    embed = discord.Embed(title="💹 現在の全銘柄価格", description=pages[page])
+    embed.set_footer(text=f"{SORT_LABELS[sort_key]}  {page + 1}/{len(pages)} ページ")
+    return embed
+
+class PriceBoardView(discord.ui.View):
+    def __init__(self, sort_key: str = "symbol"):
+        super().__init__(timeout=180)
+        self.sort_key = sort_key
+        self.page = 0
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # ボタンの処理はコマンドとは別に呼ばれるので、ここで対象サーバーを設定する
+        guilds.current_guild.set(interaction.guild_id)
+        return True
+
+    async def _show(self, interaction: discord.Interaction):
+        self.page = max(0, min(self.page, page_count(self.sort_key) - 1))
+        await interaction.response.edit_message(embed=build_embed(self.sort_key, self.page), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self._show(interaction)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self._show(interaction)
+
+    @discord.ui.button(label="銘柄名", style=discord.ButtonStyle.primary)
+    async def sort_symbol(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.sort_key, self.page = "symbol", 0
+        await self._show(interaction)
+
+    @discord.ui.button(label="騰落率", style=discord.ButtonStyle.primary)
+    async def sort_change(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.sort_key, self.page = "change", 0
+        await self._show(interaction)
+
+    @discord.ui.button(label="出来高", style=discord.ButtonStyle.primary)
+    async def sort_volume(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.sort_key, self.page = "volume", 0
+        await self._show(interaction)
@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# サンプリング間隔（秒）と最大計測時間
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 60
+
+# 同時に走らせるのは1つだけ。停止中は何も動かないのでコストはゼロ
+_running = threading.Lock()
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def sample(seconds: float, interval: float = DEFAULT_INTERVAL) -> tuple[Counter, int]:
+    """
+    全スレッド（イベントループと executor スレッド）のスタックを定期的に採取する。
+    戻り値は ({"スレッド名;外側;...;内側": 回数}, 採取回数)
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(labels))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def collapsed(stacks: Counter) -> str:
+    """flamegraph.pl / speedscope で読める collapsed-stack 形式"""
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+def top_functions(stacks: Counter, samples: int, limit: int = 10) -> list[tuple[str, float]]:
+    """各サンプルで一番内側にいた関数の割合（待機中のスレッドも含む）"""
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [(name, count / samples * 100) for name, count in leaves.most_common(limit)] if samples else []
+
+def run(seconds: float, interval: float = DEFAULT_INTERVAL):
+    """executor から呼ぶ。実行中なら None を返す"""
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        seconds = max(1.0, min(float(seconds), MAX_SECONDS))
+        stacks, samples = sample(seconds, interval)
+        return collapsed(stacks), top_functions(stacks, samples), samples
+    finally:
+        _running.release()
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+# コマンドごとのコスト（トークン数）
+COMMAND_COSTS = {
+    "buy": 2.0,
+    "sell": 2.0,
+    "transfer": 3.0,
+    "order": 2.0,
+}
+
+# ユーザーごとのバケット: 最大 USER_BURST トークン、毎秒 USER_RATE 回復
+USER_RATE = 0.5
+USER_BURST = 6.0
+# 全体のバケット: DB書き込みの総量を抑える
+GLOBAL_RATE = 20.0
+GLOBAL_BURST = 40.0
+# 全体バケットの順番待ちに並べる最大数と最大待ち時間（秒）
+MAX_PENDING = 50
+MAX_WAIT = 2.0  # Discordの応答期限（3秒）より短くする
+# 使われなくなったユーザーバケットを掃除する間隔（秒）
+IDLE_EXPIRE = 600
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, cost: float) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def reserve(self, cost: float) -> float:
+        """トークンを前借りし、使えるようになるまでの待ち秒数を返す"""
+        self._refill(time.monotonic())
+        self.tokens -= cost
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, cost: float):
+        self.tokens = min(self.burst, self.tokens + cost)
+
+class AdmissionController:
+    """ユーザー単位・全体のトークンバケットで重いコマンドの受付を制御する"""
+
+    def __init__(self, costs=None, user_rate=USER_RATE, user_burst=USER_BURST,
+                 global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 max_pending=MAX_PENDING, max_wait=MAX_WAIT):
+        self.costs = dict(COMMAND_COSTS if costs is None else costs)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.pending = 0
+        self.rejected = 0
+        self._users = {}
+        self._last_sweep = time.monotonic()
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._last_sweep > IDLE_EXPIRE:
+            # 満タンまで回復したバケットは初期状態と同じなので捨ててよい
+            for uid in [u for u, b in self._users.items() if now - b.updated > IDLE_EXPIRE]:
+                del self._users[uid]
+            self._last_sweep = now
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    async def acquire(self, user_id: str, command: str) -> bool:
+        """受付できればTrue。連打しているユーザーや混雑時は即座にFalseを返す"""
+        cost = self.costs.get(command, 1.0)
+        user_bucket = self._user_bucket(user_id)
+        if not user_bucket.try_take(cost):
+            self.rejected += 1
+            return False
+
+        if self.global_bucket.try_take(cost):
+            return True
+
+        # 全体が混んでいる時だけ、上限付きの待ち行列に並ぶ
+        if self.pending >= self.max_pending:
+            user_bucket.refund(cost)
+            self.rejected += 1
+            return False
+
+        wait = self.global_bucket.reserve(cost)
+        if wait > self.max_wait:
+            self.global_bucket.refund(cost)
+            user_bucket.refund(cost)
+            self.rejected += 1
+            return False
+
+        self.pending += 1
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.pending -= 1
+        return True
+
+admission = AdmissionController()
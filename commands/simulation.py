@@ -0,0 +1,150 @@
+"""
+Discordなしで市場エンジンを早回しするシミュレーション。
+
+    python -m commands.simulation --symbols 1000 --days 1 --seed 42
+
+仮想時計とシード付き乱数で動くので、同じ引数なら同じ結果になる。
+価格更新・約定・履歴記録・間引き・自動売却は本番と同じ関数を使う。
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from commands import stock_manager
+from commands import stock_trading
+from commands import user_manager
+from commands import stock_graph
+from commands import order_book
+from commands import market_engine
+from commands import ledger
+from commands import db_maintenance
+from commands import market_index
+
+class VirtualClock:
+    def __init__(self, start: float):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+def use_database(db_path: str):
+    """全モジュールの接続先を差し替える"""
+    for module in (stock_manager, stock_trading, user_manager, stock_graph, ledger, db_maintenance, market_index):
+        module.DB_PATH = db_path
+    stock_manager.reset_state()
+
+def seed_market(rng: random.Random, symbols: int, speed: tuple, min_fluct: tuple, max_fluct: tuple, traders: int):
+    stock_manager.init_db()
+    ledger.init_ledger()
+    with stock_manager.get_connection() as conn:
+        rows = []
+        for i in range(symbols):
+            min_f = rng.randint(*min_fluct)
+            rows.append((
+                f"SIM{i:04d}",
+                rng.randint(50, 500),
+                rng.randint(*speed),
+                min_f,
+                max(min_f, rng.randint(*max_fluct)),
+                None,
+                "sim-creator",
+            ))
+        conn.executemany("""
+            INSERT OR REPLACE INTO stocks
+            (symbol, price, speed, min_fluct, max_fluct, channel_id, added_by_user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+    for t in range(traders):
+        user_manager.init_user(f"sim-trader-{t}")
+        user_manager.add_balance(f"sim-trader-{t}", 10_000_000)
+    order_book.load_orders()
+
+def run(args) -> dict:
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="vety-sim-"), "sim.db")
+    use_database(db_path)
+
+    clock = VirtualClock(args.start)
+    stock_manager.clock = clock.time
+    stock_manager.rng = random.Random(args.seed)
+    # 取引の乱数はエンジンの乱数と分けて、取引量を変えても価格系列が変わらないようにする
+    trade_rng = random.Random(args.seed + 1)
+
+    seed_market(trade_rng, args.symbols, tuple(args.speed), tuple(args.min_fluct), tuple(args.max_fluct), args.traders)
+    symbols = [f"SIM{i:04d}" for i in range(args.symbols)]
+    size_before = os.path.getsize(db_path)
+
+    ticks = int(args.days * 86400) if args.days else args.ticks
+    tick_times = []
+    next_auto_sell = market_engine.AUTO_SELL_INTERVAL
+    changes_total = fills_total = auto_sells = 0
+    started = time.perf_counter()
+
+    for tick in range(ticks):
+        t0 = time.perf_counter()
+        changes, fills, _updates = market_engine.run_tick()
+        changes_total += len(changes)
+        fills_total += len(fills)
+
+        if args.traders and tick % args.trade_every == 0:
+            trader = f"sim-trader-{trade_rng.randrange(args.traders)}"
+            stock_trading.buy_stock(trader, trade_rng.choice(symbols), trade_rng.randint(1, 10), trade_rng.randint(1, 30))
+
+        if tick >= next_auto_sell:
+            auto_sells += len(market_engine.run_auto_sell())
+            next_auto_sell = tick + market_engine.AUTO_SELL_INTERVAL
+
+        tick_times.append(time.perf_counter() - t0)
+        clock.advance(market_engine.TICK_INTERVAL)
+
+        if args.progress and (tick + 1) % args.progress == 0:
+            elapsed = time.perf_counter() - started
+            print(f"{tick + 1}/{ticks} ticks  {(tick + 1) / elapsed:.1f} ticks/s")
+
+    elapsed = time.perf_counter() - started
+    with sqlite3.connect(db_path) as conn:
+        history_rows = conn.execute("SELECT COUNT(*) FROM stock_history").fetchone()[0]
+    size_after = os.path.getsize(db_path)
+    tick_times.sort()
+
+    return {
+        "db": db_path,
+        "seed": args.seed,
+        "symbols": args.symbols,
+        "ticks": ticks,
+        "elapsed_sec": round(elapsed, 3),
+        "ticks_per_sec": round(ticks / elapsed, 1) if elapsed else None,
+        "tick_p50_ms": round(tick_times[len(tick_times) // 2] * 1000, 3) if tick_times else None,
+        "tick_p99_ms": round(tick_times[int(len(tick_times) * 0.99)] * 1000, 3) if tick_times else None,
+        "price_changes": changes_total,
+        "order_fills": fills_total,
+        "auto_sells": auto_sells,
+        "history_rows": history_rows,
+        "db_bytes_before": size_before,
+        "db_bytes_after": size_after,
+        "final_prices_sample": sorted(stock_manager.get_all_prices())[:5],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="市場エンジンの早回しシミュレーション")
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=3600, help="実行するティック数（1ティック = 仮想1秒）")
+    parser.add_argument("--days", type=float, default=0, help="指定すると ticks の代わりに日数で実行")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", type=float, default=1_700_000_000, help="仮想時計の開始UNIX秒")
+    parser.add_argument("--speed", type=int, nargs=2, default=(1, 60), metavar=("MIN", "MAX"))
+    parser.add_argument("--min-fluct", type=int, nargs=2, default=(1, 5), metavar=("MIN", "MAX"))
+    parser.add_argument("--max-fluct", type=int, nargs=2, default=(5, 20), metavar=("MIN", "MAX"))
+    parser.add_argument("--traders", type=int, default=0, help="自動売却付きで買い続ける仮想ユーザー数")
+    parser.add_argument("--trade-every", type=int, default=5, help="何ティックごとに1件買うか")
+    parser.add_argument("--db", help="使用するDBファイル（省略時は一時ディレクトリ）")
+    parser.add_argument("--progress", type=int, default=0, help="何ティックごとに進捗を表示するか")
+    print(json.dumps(run(parser.parse_args()), ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
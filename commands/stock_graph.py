@@ -1,17 +1,23 @@
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
 import sqlite3
+import io
 from datetime import datetime
 import os
+from commands import metrics
+from commands import guilds
 
-# 絶対パスに変換し、sharedフォルダを自動作成
+# 絶対パスに変換
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
-os.makedirs(DB_DIR, exist_ok=True)  # ← 重要: sharedディレクトリがなければ作る
 
 DB_PATH = os.path.join(DB_DIR, "shared.db")
 
+def _pyplot():
+    """matplotlib は重いので最初のグラフ描画時に読み込む"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
 def _to_dt(ts):
     """timestampが str / int(UNIX秒) / datetime / bytes など混在しても安全にdatetimeへ"""
     if isinstance(ts, datetime):
@@ -46,7 +52,7 @@ def _to_dt(ts):
     return None
 
 def generate_stock_graph(symbol: str, filename: str) -> bool:
-    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn = sqlite3.connect(guilds.db_path(DB_PATH), timeout=10, factory=metrics.InstrumentedConnection)
     c = conn.cursor()
     # text/整数どちらでも拾えるようにしつつ、明らかなゴミは弾く
     c.execute(
@@ -76,6 +82,7 @@ def generate_stock_graph(symbol: str, filename: str) -> bool:
     if not times:
         return False
 
+    plt = _pyplot()
     plt.style.use("default")
     fig, ax = plt.subplots(figsize=(7, 4))
     ax.plot(times, prices, marker="o", linewidth=2.0, markersize=4)
@@ -98,3 +105,108 @@ def generate_stock_graph(symbol: str, filename: str) -> bool:
     plt.savefig(full_path)
     plt.close()
     return os.path.exists(full_path)
+
+def fetch_histories(symbols: list[str]) -> dict:
+    """
+    複数銘柄の履歴を共通の期間でまとめて取得する {symbol: [(datetime, price), ...]}
+    期間の始まりは「全銘柄の履歴が揃っている最初の時刻」。各系列の先頭はその時刻での価格
+    （履歴は価格が動いた時だけ記録されるので、それ以前の最後の価格）にそろえる
+    """
+    if not symbols:
+        return {}
+    placeholders = ",".join("?" for _ in symbols)
+    conn = sqlite3.connect(guilds.db_path(DB_PATH), timeout=10, factory=metrics.InstrumentedConnection)
+    try:
+        c = conn.cursor()
+        # 更新間隔（speed）の違う銘柄でも同じ期間を比べるため、一番遅く履歴が始まる銘柄に合わせる
+        c.execute(
+            f"""
+            SELECT MAX(first_ts) FROM (
+                SELECT MIN(timestamp) AS first_ts FROM stock_history
+                WHERE symbol IN ({placeholders})
+                  AND timestamp IS NOT NULL
+                  AND timestamp != ''
+                GROUP BY symbol
+            )
+            """,
+            symbols,
+        )
+        start = c.fetchone()[0]
+        if start is None:
+            return {}
+
+        # 共通の開始時刻での価格（基準）
+        c.execute(
+            f"""
+            SELECT symbol, price FROM (
+                SELECT symbol, price,
+                       ROW_NUMBER() OVER (PARTITION BY symbol ORDER BY timestamp DESC) AS rn
+                FROM stock_history
+                WHERE symbol IN ({placeholders})
+                  AND timestamp IS NOT NULL
+                  AND timestamp != ''
+                  AND timestamp <= ?
+            )
+            WHERE rn = 1
+            """,
+            (*symbols, start),
+        )
+        bases = dict(c.fetchall())
+
+        c.execute(
+            f"""
+            SELECT symbol, timestamp, price FROM stock_history
+            WHERE symbol IN ({placeholders})
+              AND timestamp > ?
+            ORDER BY symbol, timestamp ASC
+            """,
+            (*symbols, start),
+        )
+        rows = c.fetchall()
+    finally:
+        conn.close()
+
+    start_dt = _to_dt(start)
+    if start_dt is None:
+        return {}
+    histories = {symbol: [(start_dt, price)] for symbol, price in bases.items()}
+    for symbol, ts, price in rows:
+        dt = _to_dt(ts)
+        if dt is None or symbol not in histories:
+            continue
+        histories[symbol].append((dt, price))
+    return histories
+
+def generate_comparison_graph(symbols: list[str]) -> bytes | None:
+    """複数銘柄を共通の開始時刻の価格からの騰落率(%)に揃えて1枚のグラフに描き、PNGのバイト列を返す"""
+    histories = fetch_histories(symbols)
+    if not histories:
+        return None
+
+    # pyplot のグローバル状態を使わないので executor スレッドから呼んでも安全
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(7, 4))
+    ax = fig.subplots()
+    for symbol in symbols:
+        points = histories.get(symbol)
+        if not points:
+            continue
+        base = points[0][1] or 1
+        times = [dt for dt, _ in points]
+        changes = [(price - base) / base * 100 for _, price in points]
+        ax.plot(times, changes, linewidth=2.0, label=symbol)
+
+    ax.axhline(0, color="gray", linewidth=1)
+    ax.set_title("株価比較（騰落率）")
+    ax.set_xlabel("日時")
+    ax.set_ylabel("騰落率 (%)")
+    ax.grid(True)
+    ax.legend()
+    fig.autofmt_xdate()
+
+    # 同時実行で同じファイルを書き合わないよう、ファイルには書かずメモリ上に描く
+    buf = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
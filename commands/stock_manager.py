@@ -1,19 +1,30 @@
 import sqlite3
 import os
+import csv
+import io
 import random
 import time
 from datetime import datetime
 from discord.ext import tasks
+from commands import metrics
+from commands import guilds
+from commands import market_index
 
-# 絶対パスに変換し、sharedフォルダを自動作成
+# 絶対パスに変換
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
-os.makedirs(DB_DIR, exist_ok=True)  # ← 重要: sharedディレクトリがなければ作る
 
 DB_PATH = os.path.join(DB_DIR, "shared.db")
 
 def get_connection():
-    return sqlite3.connect(DB_PATH, timeout=10)
+    return sqlite3.connect(guilds.db_path(DB_PATH), timeout=10, factory=metrics.InstrumentedConnection)
+
+# 時刻と乱数の供給元（シミュレーションでは仮想時計・シード付き乱数に差し替える）
+clock = time.time
+rng = random.Random()
+
+def now_dt() -> datetime:
+    return datetime.fromtimestamp(clock())
 
 def init_db():
     with get_connection() as conn:
@@ -50,6 +61,13 @@ def init_db():
             )
         """)
 
+        # 直近価格の参照・履歴の間引き・グラフ描画はすべて銘柄×時刻で引く
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_stock_history_symbol_ts
+            ON stock_history(symbol, timestamp)
+        """)
+
+        market_index.init_tables(c)
         conn.commit()
 
 def get_all_prices():
@@ -58,12 +76,37 @@ def get_all_prices():
         c.execute("SELECT symbol, price FROM stocks")
         return c.fetchall()
 
-# キャッシュとして保持
-last_update_times = {}
+class _MarketState:
+    """サーバーごとに持つキャッシュ"""
+
+    def __init__(self):
+        self.last_update_times = {}
+        # 最後に履歴へ記録した価格（なければDBから引く）
+        self.last_logged_prices = {}
+        # 前回の間引き以降に履歴が増えた銘柄（None は未実施 = 全銘柄を確認）
+        self.history_grown = None
+
+def _state() -> _MarketState:
+    return guilds.local("stock_manager", _MarketState)
+
+def reset_state():
+    """プロセス内のキャッシュを捨てる（DBを差し替えた時など）"""
+    guilds.reset("stock_manager")
+    market_index.reset_state()
+
+def forget_symbols(symbols):
+    """追加・置換・削除した銘柄のキャッシュを捨てる（市場エンジンのプロセスでも呼ぶ）"""
+    state = _state()
+    for symbol in symbols:
+        state.last_logged_prices.pop(symbol, None)
+        state.last_update_times.pop(symbol, None)
 
 def random_update_prices():
-    now = time.time()
-    
+    """価格を更新し、変動した銘柄の (symbol, 旧価格, 新価格) を返す"""
+    now = clock()
+    changes = []
+    last_update_times = _state().last_update_times
+
     with get_connection() as conn:
         c = conn.cursor()
         c.execute("SELECT symbol, price, speed, min_fluct, max_fluct FROM stocks")
@@ -75,29 +118,37 @@ def random_update_prices():
             if last_time is not None and now - last_time < speed:
                 continue  # 更新間隔に満たない
 
-            fluct = random.uniform(min_f, max_f)
-            direction = random.choice([-1, 1])
+            fluct = rng.uniform(min_f, max_f)
+            direction = rng.choice([-1, 1])
             delta = int(fluct * direction)
             new_price = max(1, price + delta)
 
             c.execute("UPDATE stocks SET price = ? WHERE symbol = ?", (new_price, symbol))
             last_update_times[symbol] = now  # 最終更新時刻を記録
+            if new_price != price:
+                changes.append((symbol, price, new_price))
 
         conn.commit()
+    return changes
 
 def log_current_prices():
+    state = _state()
+    last_logged_prices = state.last_logged_prices
     with get_connection() as conn:
         c = conn.cursor()
-        now = datetime.now().replace(microsecond=0)
+        now = now_dt().replace(microsecond=0)
 
         # 現在の価格、チャンネルIDを取得
         c.execute("SELECT symbol, price, channel_id FROM stocks")
         stock_rows = c.fetchall()
 
-        # 各symbolの前回価格を取得して差分計算
+        # 各symbolの前回価格（キャッシュになければ履歴から取得）
         prev_prices = {}
         for row in stock_rows:
             symbol = row[0]
+            if symbol in last_logged_prices:
+                prev_prices[symbol] = last_logged_prices[symbol]
+                continue
             c.execute("""SELECT price FROM stock_history 
                          WHERE symbol = ? 
                          ORDER BY timestamp DESC LIMIT 1""", (symbol,))
@@ -105,10 +156,12 @@ def log_current_prices():
             prev_prices[symbol] = fetched[0] if fetched else None
 
         updates = []
+        logged = []
 
         for symbol, current_price, channel_id in stock_rows:
             prev_price = prev_prices.get(symbol)
             if prev_price is not None and current_price == prev_price:
+                last_logged_prices[symbol] = prev_price
                 continue
 
             delta = current_price - prev_price if prev_price is not None else 0
@@ -118,23 +171,36 @@ def log_current_prices():
                 INSERT INTO stock_history (symbol, timestamp, price, delta)
                 VALUES (?, ?, ?, ?)
             """, (symbol, now, current_price, delta))
+            logged.append((symbol, current_price))
 
             # チャンネル通知メッセージ作成
             if channel_id:
                 message = f"`{symbol}` の現在価格: `{current_price}`Vety（前回比: {delta:+}Vety）"
                 updates.append((int(channel_id), message))
 
+        # 記録した銘柄の差分だけで指数を更新し、同じトランザクションで記録する
+        logged += market_index.apply(c, logged, now)
         conn.commit()
-        return updates
+
+    # コミットできた分だけキャッシュに反映
+    for symbol, price in logged:
+        last_logged_prices[symbol] = price
+        if state.history_grown is not None:
+            state.history_grown.add(symbol)
+    return updates
 
 
 def cleanup_old_history(limit: int = 100):
+    state = _state()
     with get_connection() as conn:
         c = conn.cursor()
 
-        # 対象となる銘柄一覧を取得
-        c.execute("SELECT DISTINCT symbol FROM stock_history")
-        symbols = [row[0] for row in c.fetchall()]
+        # 対象となる銘柄一覧を取得（初回以外は履歴が増えた銘柄だけ）
+        if state.history_grown is None:
+            c.execute("SELECT DISTINCT symbol FROM stock_history")
+            symbols = [row[0] for row in c.fetchall()]
+        else:
+            symbols = list(state.history_grown)
 
         for symbol in symbols:
             # 現在の履歴数を確認
@@ -155,22 +221,105 @@ def cleanup_old_history(limit: int = 100):
                 """, (symbol, delete_count))
 
         conn.commit()
+    state.history_grown = set()
  
+def is_reserved_symbol(symbol) -> bool:
+    """指数（^MARKET 等）と同じ名前空間を使う銘柄コードは作らせない"""
+    return str(symbol).startswith(market_index.INDEX_PREFIX)
+
+RESERVED_SYMBOL_MESSAGE = f"銘柄コードの先頭に {market_index.INDEX_PREFIX} は使えません（指数用）"
+
 def add_stock(symbol, price, speed, min_fluct, max_fluct, channel_id, added_by_user_id):
+    if is_reserved_symbol(symbol):
+        raise ValueError(RESERVED_SYMBOL_MESSAGE)
     with get_connection() as conn:
         c = conn.cursor()
+        before = market_index.aggregates(c)
         c.execute("""
             INSERT OR REPLACE INTO stocks 
             (symbol, price, speed, min_fluct, max_fluct, channel_id, added_by_user_id)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         """, (symbol, price, speed, min_fluct, max_fluct, channel_id, added_by_user_id))
+        market_index.rebalance(c, before)  # 銘柄の追加で指数値が跳ねないようにする
+        conn.commit()
+    forget_symbols([symbol])
+
+STOCK_CSV_COLUMNS = ("symbol", "price", "speed", "min_fluct", "max_fluct", "channel_id", "added_by_user_id")
+
+def parse_stock_csv(text: str, default_channel_id=None, default_user_id=None):
+    """
+    銘柄定義のCSVを読み込む。1行目はヘッダ（symbol,price,speed,min_fluct,max_fluct[,channel_id,added_by_user_id]）
+    戻り値は (add_stocks_bulk に渡せる行のリスト, エラーメッセージのリスト)
+    """
+    rows, errors = [], []
+    reader = csv.DictReader(io.StringIO(text.lstrip("\ufeff")))
+    missing = [col for col in STOCK_CSV_COLUMNS[:5] if col not in (reader.fieldnames or [])]
+    if missing:
+        return [], [f"ヘッダに {', '.join(missing)} がありません"]
+
+    for line_no, rec in enumerate(reader, start=2):
+        try:
+            symbol = (rec["symbol"] or "").strip().upper()
+            if not symbol:
+                raise ValueError("symbol が空です")
+            if is_reserved_symbol(symbol):
+                raise ValueError(RESERVED_SYMBOL_MESSAGE)
+            price = int(float(rec["price"]))
+            speed = int(float(rec["speed"]))
+            min_f = int(float(rec["min_fluct"]))
+            max_f = int(float(rec["max_fluct"]))
+            if price <= 0 or speed < 0 or min_f < 0 or max_f < min_f:
+                raise ValueError("数値の範囲が不正です")
+            # どちらも Discord のID。数値でないと価格通知（int(channel_id)）で毎ティック失敗する
+            channel_id = (rec.get("channel_id") or "").strip() or default_channel_id
+            added_by = (rec.get("added_by_user_id") or "").strip() or default_user_id
+            for name, value in (("channel_id", channel_id), ("added_by_user_id", added_by)):
+                if value is not None and not str(value).isdigit():
+                    raise ValueError(f"{name} は数値のIDで指定してください")
+        except (TypeError, ValueError) as e:
+            errors.append(f"{line_no}行目: {e}")
+            continue
+        rows.append((symbol, price, speed, min_f, max_f, channel_id, added_by))
+    return rows, errors
+
+def add_stocks_bulk(rows, progress=None, chunk_size: int = 1000) -> int:
+    """複数銘柄を1トランザクションで追加する。progress(済み件数, 全件数) を途中で呼ぶ"""
+    if any(is_reserved_symbol(row[0]) for row in rows):
+        raise ValueError(RESERVED_SYMBOL_MESSAGE)
+    with get_connection() as conn:
+        c = conn.cursor()
+        before = market_index.aggregates(c)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            c.executemany("""
+                INSERT OR REPLACE INTO stocks
+                (symbol, price, speed, min_fluct, max_fluct, channel_id, added_by_user_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, chunk)
+            if progress:
+                progress(start + len(chunk), len(rows))
+        market_index.rebalance(c, before)
         conn.commit()
 
+    # 置き換えた銘柄のキャッシュは最後に1回だけ捨てる
+    forget_symbols(row[0] for row in rows)
+    return len(rows)
+
 def delete_stock(symbol):
+    # order_book は stock_trading 経由でこのモジュールを読み込むため、ここで読み込む
+    from commands import order_book
+
     with get_connection() as conn:
+        c = conn.cursor()
+        conn.execute("BEGIN IMMEDIATE")
+        order_book.cancel_symbol_orders(c, symbol)  # 未約定注文の取消・返金も同じトランザクションで行う
+        before = market_index.aggregates(c)
         conn.execute("DELETE FROM stocks WHERE symbol = ?", (symbol,))
         conn.execute("DELETE FROM user_stocks WHERE symbol = ?", (symbol,))
         conn.execute("DELETE FROM stock_history WHERE symbol = ?", (symbol,))
+        conn.execute("DELETE FROM sector_members WHERE symbol = ?", (symbol,))
+        market_index.rebalance(c, before)
+    forget_symbols([symbol])
 
 def get_price(symbol):
     with get_connection() as conn:
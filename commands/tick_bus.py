@@ -0,0 +1,96 @@
+import asyncio
+from typing import NamedTuple
+from commands import guilds
+
+# 購読者ごとのキューに溜められるバッチ数
+DEFAULT_QUEUE_SIZE = 32
+
+class TickEvent(NamedTuple):
+    symbol: str
+    old_price: int
+    new_price: int
+    ts: float
+
+class _Queue:
+    """1つのサーバー・1つの購読者ぶんのキュー"""
+
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.lagged = False  # バッチを捨てた後、次のバッチの前に on_lag を呼ぶ
+        self.task = None
+
+class _Subscriber:
+    def __init__(self, name: str, callback, maxsize: int, on_lag=None):
+        self.name = name
+        self.callback = callback
+        self.on_lag = on_lag
+        self.maxsize = maxsize
+        # サーバーごとのキュー。混んでいるサーバーのバッチが他のサーバーのバッチを押し出さないよう分ける
+        self.queues = {}
+
+    def queue_for(self, guild_id) -> _Queue:
+        key = guilds.partition(guild_id)
+        q = self.queues.get(key)
+        if q is None:
+            q = self.queues[key] = _Queue(self.maxsize)
+        return q
+
+    def start(self, guild_id, q: _Queue):
+        if q.task is None:
+            # 発行したサーバーの市場として購読者を呼ぶ
+            q.task = guilds.create_task(guild_id, self.run, q)
+
+    async def run(self, q: _Queue):
+        while True:
+            batch = await q.queue.get()
+            try:
+                if q.lagged:
+                    # 差分を取りこぼしたので、購読者に全体を作り直させる
+                    q.lagged = False
+                    if self.on_lag:
+                        self.on_lag()
+                await self.callback(batch)
+            except Exception as e:
+                # 1つの購読者の失敗で他の購読者や価格ループを止めない
+                print(f"❌ tick購読者 {self.name} でエラー: {e}")
+
+class TickBus:
+    """価格ループが1ティックごとに発行する価格変動バッチを購読者へ配る"""
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, name: str, callback, maxsize: int = DEFAULT_QUEUE_SIZE, on_lag=None):
+        """
+        callback は batch（TickEvent のタプル）を受け取る async 関数。発行元のサーバーで呼ばれる。
+        on_lag はキューあふれでバッチを捨てた後、次の callback の前に呼ばれる（同期関数）
+        """
+        sub = _Subscriber(name, callback, maxsize, on_lag)
+        self._subscribers.append(sub)
+        return sub
+
+    def publish(self, changes, ts: float):
+        """changes: (symbol, 旧価格, 新価格) の並び。変動がなくても空バッチを配る"""
+        batch = tuple(TickEvent(symbol, old, new, ts) for symbol, old, new in changes)
+        guild_id = guilds.current_guild.get()
+        for sub in self._subscribers:
+            q = sub.queue_for(guild_id)
+            sub.start(guild_id, q)  # キューの処理タスクはそのサーバーの初回発行時に起動する
+            if q.queue.full():
+                # 遅い購読者は古いバッチから捨てる（価格ループは待たない）
+                q.queue.get_nowait()
+                q.dropped += 1
+                q.lagged = True
+            q.queue.put_nowait(batch)
+        return batch
+
+    def stats(self):
+        """(購読者名, サーバー, キュー長, 捨てたバッチ数) のリスト"""
+        return [
+            (sub.name, key, q.queue.qsize(), q.dropped)
+            for sub in self._subscribers
+            for key, q in sub.queues.items()
+        ]
+
+bus = TickBus()
@@ -1,15 +1,17 @@
 import sqlite3
 import os
+from commands import metrics
+from commands import guilds
+from commands import ledger
 
-# 絶対パスに変換し、sharedフォルダを自動作成
+# 絶対パスに変換
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(BASE_DIR, "..", "..", "shared")
-os.makedirs(DB_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DB_DIR, "shared.db")
 
 def get_connection():
-    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn = sqlite3.connect(guilds.db_path(DB_PATH), timeout=30, check_same_thread=False, factory=metrics.InstrumentedConnection)
     # ある程度同時アクセスに強くする
     conn.execute("PRAGMA foreign_keys = ON;")
     conn.execute("PRAGMA journal_mode = WAL;")
@@ -33,29 +35,18 @@ def init_user(user_id: str):
 
 def get_balance(user_id: str) -> float:
     with get_connection() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT balance FROM balances
-            WHERE user_id = ? AND currency = 'VETY'
-        """, (user_id,))
-        row = c.fetchone()
-        return row[0] if row else 0.0
+        return ledger.balance_of(conn.cursor(), user_id)
 
-def add_balance(user_id: str, amount: float):
+def add_balance(user_id: str, amount: float, issued_by: str | None = None):
     amount = float(amount)
     if amount <= 0:
         return
     with get_connection() as conn:
         c = conn.cursor()
-        c.execute("""
-            INSERT OR IGNORE INTO balances(user_id, currency, balance)
-            VALUES (?, 'VETY', 0)
-        """, (user_id,))
-        c.execute("""
-            UPDATE balances
-            SET balance = balance + ?
-            WHERE user_id = ? AND currency = 'VETY'
-        """, (amount, user_id))
+        ledger.post(c, [
+            (ledger.ISSUE, ledger.TREASURY, -amount, user_id, None),
+            (ledger.ISSUE, user_id, amount, issued_by or ledger.TREASURY, None),
+        ])
 
 def decrease_balance(user_id: str, amount: float, currency: str = "VETY") -> bool:
     amount = float(amount)
@@ -66,44 +57,16 @@ def decrease_balance(user_id: str, amount: float, currency: str = "VETY") -> boo
 
     with get_connection() as conn:
         c = conn.cursor()
+        ledger.begin(conn)
 
-        # 口座が無ければ 0 で作成
-        c.execute("""
-            INSERT OR IGNORE INTO balances (user_id, currency, balance)
-            VALUES (?, ?, 0)
-        """, (user_id, cur))
-
-        # 残高が十分な時だけ原子的に減額
-        c.execute("""
-            UPDATE balances
-               SET balance = balance - ?
-             WHERE user_id = ?
-               AND UPPER(currency) = UPPER(?)
-               AND balance >= ?
-        """, (amount, user_id, cur, amount))
-
-        ok = (c.rowcount == 1)
+        # 残高が十分な時だけ減額の仕訳を追記
+        if ledger.balance_of(c, user_id, cur) < amount:
+            conn.rollback()
+            return False
+
+        ledger.post(c, ledger.entry(ledger.BURN, user_id, ledger.TREASURY, amount, currency=cur))
         conn.commit()
-        return ok
-    
-def _normalize_balance_row(conn, user_id: str, currency: str) -> None:
-    cur = currency.upper()
-    c = conn.cursor()
-    # 大小混在の合計を作る
-    c.execute("""
-        SELECT COALESCE(SUM(balance), 0)
-        FROM balances
-        WHERE user_id = ? AND UPPER(currency) = UPPER(?)
-    """, (user_id, cur))
-    total = c.fetchone()[0] or 0
-
-    # 既存の大小混在行を全部消して、1行だけ入れ直す
-    c.execute("DELETE FROM balances WHERE user_id = ? AND UPPER(currency) = UPPER(?)",
-              (user_id, cur))
-    c.execute("""
-        INSERT INTO balances (user_id, currency, balance)
-        VALUES (?, ?, ?)
-    """, (user_id, cur, total))
+        return True
 
 def transfer_balance(from_user_id: str, to_user_id: str, amount: float, currency: str = "VETY") -> bool:
     amount = float(amount)
@@ -114,43 +77,18 @@ def transfer_balance(from_user_id: str, to_user_id: str, amount: float, currency
     with get_connection() as conn:
         c = conn.cursor()
         try:
-            c.execute("BEGIN")
-
-            # まず両者の通貨行を正規化（重複行を1行に統合）
-            _normalize_balance_row(conn, from_user_id, cur)
-            _normalize_balance_row(conn, to_user_id, cur)
-
-            # 送金元の残高確認（合計で確認）
-            c.execute("""
-                SELECT balance FROM balances
-                WHERE user_id = ? AND currency = ?
-                LIMIT 1
-            """, (from_user_id, cur))
-            row = c.fetchone()
-            bal = row[0] if row else 0
-            if bal < amount:
-                conn.rollback()
-                return False
+            ledger.begin(conn)
 
-            # 減額（原子的）
-            c.execute("""
-                UPDATE balances
-                   SET balance = balance - ?
-                 WHERE user_id = ? AND currency = ? AND balance >= ?
-            """, (amount, from_user_id, cur, amount))
-            if c.rowcount != 1:
+            # 送金元の残高確認（スナップショット + 未反映の仕訳）
+            if ledger.balance_of(c, from_user_id, cur) < amount:
                 conn.rollback()
                 return False
 
-            # 加算
-            c.execute("""
-                UPDATE balances
-                   SET balance = balance + ?
-                 WHERE user_id = ? AND currency = ?
-            """, (amount, to_user_id, cur))
-            if c.rowcount != 1:
-                conn.rollback()
-                return False
+            # 送金元・送金先の2行を1回で追記
+            ledger.post(c, [
+                (ledger.TRANSFER, from_user_id, cur, -amount, to_user_id, None),
+                (ledger.TRANSFER, to_user_id, cur, amount, from_user_id, None),
+            ])
 
             conn.commit()
             return True
@@ -158,5 +96,31 @@ def transfer_balance(from_user_id: str, to_user_id: str, amount: float, currency
             conn.rollback()
             return False
 
-def log_issuance(issued_by: str, issued_to: str, amount: float):
-    pass
+def bulk_adjust(user_ids, amount: float, issued_by: str | None = None, progress=None,
+                chunk_size: int = 1000) -> tuple[int, int]:
+    """
+    複数ユーザーに同額を発行（amount > 0）または減額（amount < 0）する。1トランザクションで処理。
+    progress(済み人数, 全人数) を途中で呼ぶ。戻り値は (処理した人数, 残高不足でスキップした人数)
+    """
+    amount = float(amount)
+    if amount == 0:
+        return 0, 0
+    user_ids = list(dict.fromkeys(user_ids))  # 重複を除く（順序は維持）
+    kind = ledger.ISSUE if amount > 0 else ledger.BURN
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        ledger.begin(conn)
+        done = 0
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            if amount < 0:
+                chunk = [uid for uid in chunk if ledger.balance_of(c, uid) >= -amount]
+            if chunk:
+                ledger.post(c, [(kind, uid, amount, issued_by or ledger.TREASURY, "bulk") for uid in chunk]
+                            + [(kind, ledger.TREASURY, -amount * len(chunk), None, "bulk")])
+            done += len(chunk)
+            if progress:
+                progress(min(start + chunk_size, len(user_ids)), len(user_ids))
+        conn.commit()
+        return done, len(user_ids) - done
@@ -0,0 +1,167 @@
+import pytest
+from commands import db_maintenance
+from commands import market_index
+from commands import stock_graph
+from commands import stock_manager
+from commands import stock_trading
+from commands import user_manager
+from commands import order_book
+from commands import ledger
+
+@pytest.fixture
+def market(tmp_path, monkeypatch):
+    # モジュールごとの DB_PATH はテストの終わりに元へ戻す
+    db_path = str(tmp_path / "shared.db")
+    for module in (stock_manager, stock_trading, user_manager, stock_graph, ledger, db_maintenance, market_index):
+        monkeypatch.setattr(module, "DB_PATH", db_path)
+    stock_manager.reset_state()
+    stock_manager.init_db()
+    ledger.init_ledger()
+    order_book.init_orders_table()
+    stock_manager.add_stock("AAA", 100, 1, 1, 2, None, "creator")
+    yield
+    order_book._state().books.clear()
+    order_book._state().cancelled.clear()
+    stock_manager.reset_state()
+
+def _applied_id(c):
+    c.execute("SELECT value FROM ledger_state WHERE key = 'applied_id'")
+    return c.fetchone()[0]
+
+def _all_balances(c):
+    c.execute("SELECT DISTINCT user_id FROM ledger UNION SELECT user_id FROM balances WHERE currency = 'VETY'")
+    return {user_id: ledger.balance_of(c, user_id) for (user_id,) in c.fetchall()}
+
+def _trade(user):
+    user_manager.add_balance(user, 10_000, issued_by="admin")
+    user_manager.add_balance("creator", 500)
+    stock_trading.buy_stock(user, "AAA", 10)
+    user_manager.transfer_balance(user, "creator", 250)
+    order_book.place_order(user, "AAA", order_book.LIMIT_BUY, 5, 90)
+    order_book.match_orders([("AAA", 100, 80)])
+    order_book.place_order(user, "AAA", order_book.LIMIT_BUY, 3, 70)
+    with stock_manager.get_connection() as conn:
+        conn.execute("UPDATE stocks SET price = 60 WHERE symbol = 'AAA'")
+    stock_trading.sell_stock(user, "AAA", 4)  # 売却損の還元が発生する
+    user_manager.bulk_adjust([user, "creator"], -100, issued_by="admin")
+
+def test_post_rejects_unbalanced(market):
+    with ledger.get_connection() as conn:
+        with pytest.raises(ValueError):
+            ledger.post(conn.cursor(), [(ledger.ISSUE, "u1", 100, None, None)])
+
+def test_balances_survive_compact(market):
+    _trade("u1")
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        before = _all_balances(c)
+        assert ledger.unbalanced(c) == []
+
+    assert ledger.compact() > 0
+
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        assert _all_balances(c) == before
+        assert ledger.unbalanced(c) == []
+        # 反映済み位置は最新の仕訳を指し、未反映の仕訳は残らない
+        c.execute("SELECT MAX(posting_id) FROM ledger")
+        latest = c.fetchone()[0]
+        assert _applied_id(c) == latest
+        c.execute("SELECT SUM(balance) FROM balances WHERE currency = 'VETY'")
+        assert c.fetchone()[0] == pytest.approx(0)
+
+    # 何もなければ位置は動かない
+    assert ledger.compact() == 0
+
+def test_compact_then_more_postings(market):
+    _trade("u1")
+    ledger.compact()
+    with ledger.get_connection() as conn:
+        applied = _applied_id(conn.cursor())
+
+    _trade("u2")
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        assert _applied_id(c) == applied  # 反映は compact だけが進める
+        before = _all_balances(c)
+
+    ledger.compact()
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        assert _all_balances(c) == before
+        assert _applied_id(c) > applied
+
+def test_user_balances_exclude_contra_accounts(market):
+    _trade("u1")
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        balances = _all_balances(c)
+    users = {k: v for k, v in balances.items() if not ledger.is_system_account(k)}
+    # 指値買いの拘束は escrow に残り、ユーザー残高には含まれない
+    assert balances[ledger.escrow(2)] == 210
+    assert sum(users.values()) == pytest.approx(-(balances[ledger.TREASURY] + balances[ledger.MARKET] + 210))
+
+def test_cancel_refunds_escrow(market):
+    user_manager.add_balance("u1", 1000)
+    order_book.place_order("u1", "AAA", order_book.LIMIT_BUY, 5, 90)
+    assert ledger.get_balance("u1") == 550
+    order_book.cancel_order("u1", 1)
+    assert ledger.get_balance("u1") == 1000
+    assert ledger.get_balance(ledger.escrow(1)) == 0
+
+def test_opening_entry_balances_legacy_rows(market):
+    with ledger.get_connection() as conn:
+        conn.execute("INSERT INTO balances (user_id, currency, balance) VALUES ('legacy', 'VETY', 300)")
+    ledger.init_ledger()
+    with ledger.get_connection() as conn:
+        c = conn.cursor()
+        assert ledger.unbalanced(c) == []
+        assert ledger.balance_of(c, "legacy") == 300
+
+def test_cancel_after_fill_does_not_refund(market):
+    user_manager.add_balance("u1", 1000)
+    order_book.place_order("u1", "AAA", order_book.LIMIT_BUY, 5, 100)
+    order_book.match_orders([("AAA", 100, 100)])
+    # 約定済みの注文は取り消せず、使い切った拘束から返金しない
+    assert "見つかりません" in order_book.cancel_order("u1", 1)
+    assert ledger.get_balance("u1") == 500
+    assert ledger.get_balance(ledger.escrow(1)) == 0
+
+def test_cancel_rechecks_status_before_refund(market, monkeypatch):
+    user_manager.add_balance("u1", 1000)
+    order_book.place_order("u1", "AAA", order_book.LIMIT_BUY, 5, 100)
+    real_connection = order_book.get_connection
+
+    class Cursor:
+        def __init__(self, c):
+            self.c = c
+
+        def __getattr__(self, name):
+            return getattr(self.c, name)
+
+        def fetchone(self):
+            row = self.c.fetchone()
+            # SELECT の直後に約定が割り込んだ状態を作る
+            self.c.execute("UPDATE stock_orders SET status = 'filled' WHERE order_id = 1")
+            return row
+
+    class Connection:
+        def __init__(self):
+            self.conn = real_connection()
+
+        def __getattr__(self, name):
+            return getattr(self.conn, name)
+
+        def __enter__(self):
+            self.conn.__enter__()
+            return self
+
+        def __exit__(self, *exc):
+            return self.conn.__exit__(*exc)
+
+        def cursor(self):
+            return Cursor(self.conn.cursor())
+
+    monkeypatch.setattr(order_book, "get_connection", Connection)
+    assert "見つかりません" in order_book.cancel_order("u1", 1)
+    assert ledger.get_balance("u1") == 500
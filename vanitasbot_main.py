@@ -3,10 +3,27 @@ from discord import app_commands
 from dotenv import load_dotenv
 import os
 import asyncio
+import hashlib
+import io
+import json
+import sqlite3
+import time
 from commands import stock_graph
 from commands import user_manager
 from commands import stock_manager
 from commands import stock_trading
+from commands import order_book
+from commands import rate_limiter
+from commands import price_board
+from commands import tick_bus
+from commands import market_engine
+from commands import metrics
+from commands import profiler
+from commands import ledger
+from commands import history_export
+from commands import db_maintenance
+from commands import guilds
+from commands import market_index
 from datetime import datetime
 from discord import app_commands, Interaction
 
@@ -15,24 +32,50 @@ TOKEN = os.getenv("DISCORD_TOKEN")
 
 intents = discord.Intents.default()
 intents.message_content = True
+# ロール一括発行でロールの全メンバーを得るには Developer Portal で Server Members Intent を有効にして 1 を指定
+intents.members = os.getenv("DISCORD_MEMBERS_INTENT") == "1"
+
+class VetyCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # コマンド・候補表示はそのサーバーの市場（DBファイル・板・価格一覧）に対して動かす
+        guilds.current_guild.set(interaction.guild_id)
+        await _ensure_market(interaction.guild_id)
+        return True
 
 class MyClient(discord.Client):
     def __init__(self):
         super().__init__(intents=intents)
-        self.tree = app_commands.CommandTree(self)
+        self.tree = VetyCommandTree(self)
 
     async def setup_hook(self):
-        await self.tree.sync()
-        print("コマンド同期完了")
+        # setup_hook はログイン時に1回だけ呼ばれる（再接続では呼ばれない）
+        _check_unpartitioned_data()
+        await _sync_commands_if_changed()
+        await _start_background()
+
+    async def close(self):
+        # 別プロセスの市場エンジンを止めてから切断する
+        for engine in list(engines.values()):
+            await engine.stop()
+        await super().close()
 
 client = MyClient()
+engines = {}  # MARKET_ENGINE=process のときのサーバーごとのワーカープロセス
 tree = client.tree  # ショートカット参照
 
 # 通貨候補用
+@metrics.timed_command
 async def autocomplete_symbols(interaction: discord.Interaction, current: str):
     syms = stock_manager.get_all_symbols(25, current or "")
     return [app_commands.Choice(name=s, value=s) for s in syms]
 
+# グラフ用（市場指数・セクター指数も候補に出す）
+@metrics.timed_command
+async def autocomplete_chart_symbols(interaction: discord.Interaction, current: str):
+    indexes = market_index.get_index_symbols(current or "", 25)
+    syms = indexes + stock_manager.get_all_symbols(25 - len(indexes), current or "")
+    return [app_commands.Choice(name=s, value=s) for s in syms]
+
 # DM送付用
 async def _send_dm_safe(user: discord.User | discord.Member, content: str):
     try:
@@ -41,40 +84,210 @@ async def _send_dm_safe(user: discord.User | discord.Member, content: str):
         # DMsを閉じている/ブロック等は無視
         pass
 
+# 連打・混雑時の受付制限
+async def _admit(interaction: discord.Interaction, command: str) -> bool:
+    if await rate_limiter.admission.acquire(str(interaction.user.id), command):
+        return True
+    await interaction.response.send_message("⏳ 操作が集中しています。少し待ってから再度お試しください。", ephemeral=True)
+    return False
+
 def _now():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-@client.event
-async def on_ready():
+# コマンド定義が変わった時だけ同期する
+def _command_hash() -> str:
+    payload = [cmd.to_dict(tree) for cmd in tree.get_commands()]
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+async def _sync_commands_if_changed():
+    path = os.path.join(os.path.dirname(stock_manager.DB_PATH), "command_hash.txt")
+    current = _command_hash()
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read().strip() == current:
+                print("コマンド定義に変更なし（同期を省略）")
+                return
+    except FileNotFoundError:
+        pass
+
     await tree.sync()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(current)
+    print("コマンド同期完了")
+
+_background_started = False
+
+async def _start_background():
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    tick_bus.bus.subscribe("price_board", price_board.on_tick, on_lag=price_board.invalidate)
+    await metrics.start_exporters()
+
+def _check_unpartitioned_data():
+    """
+    1サーバー運用の shared.db が残ったまま PRIMARY_GUILD_ID を指定しないと、
+    どのサーバーも空の新しいDBで始まってしまうので起動しない
+    """
+    if guilds.PRIMARY_GUILD_ID:
+        return
+    base = stock_manager.DB_PATH
+    partitioned = os.path.isdir(os.path.join(os.path.dirname(base), "guilds"))
+    if partitioned or not os.path.exists(base):
+        return
+    with sqlite3.connect(base) as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        has_data = any(
+            conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ("stocks", "balances", "ledger") if table in tables
+        )
+    if has_data:
+        raise RuntimeError(
+            f"{base} に既存の市場データがあります。引き継ぐサーバーのIDを PRIMARY_GUILD_ID に指定してください"
+        )
+
+# サーバーごとの市場 {市場: 準備完了の Event}。市場ごとにDBファイルと価格エンジンを持つ
+_markets = {}
+
+def _start_market(guild_id) -> asyncio.Event:
+    key = guilds.partition(guild_id)
+    ready = _markets.get(key)
+    if ready is None:
+        ready = _markets[key] = asyncio.Event()
+        guilds.create_task(guild_id, _run_market, ready)
+    return ready
+
+async def _ensure_market(guild_id):
+    await _start_market(guild_id).wait()
+
+def _init_market_db():
+    db_maintenance.init_maintenance()  # 新しいDBの auto_vacuum はテーブルを作る前に決める
     stock_manager.init_db()
+    ledger.init_ledger()
+
+async def _run_market(ready: asyncio.Event):
+    """guilds.create_task から呼ばれ、そのサーバーの市場を準備してエンジンを起動する"""
+    try:
+        await asyncio.to_thread(_init_market_db)
+        price_board.refresh()
+    finally:
+        ready.set()
+    if db_maintenance.BACKUP_INTERVAL:
+        asyncio.create_task(db_maintenance.backup_loop())
+    # サーバーごとに独立して動かす（process ではサーバーごとに別プロセス。上限を超えた分は同一プロセス）
+    if market_engine.ENGINE_MODE == "process" and len(engines) < market_engine.MAX_PROCESSES:
+        try:
+            await _start_engine_process()
+            order_book.use_remote_book()  # 板はエンジン側で組み直している
+            return
+        except Exception as e:
+            print(f"❌ 市場エンジンを起動できないため同一プロセスで動かします: {e}")
+    order_book.load_orders()
     asyncio.create_task(auto_sell_loop(client))
     asyncio.create_task(price_update_loop())
-    print(f"ログイン成功: {client.user}")
 
-async def price_update_loop():
-    await client.wait_until_ready()
+@client.event
+async def on_ready():
+    # 再接続のたびに呼ばれるので、ここでは重い処理をしない（起動済みの市場は何もしない）
+    print(f"ログイン成功: {client.user}")
+    for guild in client.guilds:
+        _start_market(guild.id)
 
-    while not client.is_closed():
-        stock_manager.random_update_prices()  # 価格を更新
-        updates = stock_manager.log_current_prices()  # 通知対象を取得
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    _start_market(guild.id)
 
+async def _start_engine_process():
+    key = guilds.partition()
+    if key in engines:
+        return
+    engine = engines[key] = market_engine.EngineProcess(_on_engine_message, guilds.current_guild.get())
+    try:
+        await engine.start()
+    except Exception:
+        del engines[key]
+        raise
+
+def _invalidate_engine(symbols: list[str]):
+    """銘柄を追加・削除した時、別プロセスの市場エンジンのキャッシュも捨てさせる"""
+    engine = engines.get(guilds.partition())
+    if engine is not None:
+        engine.invalidate(symbols)
+
+# 市場エンジン（別プロセス）からのメッセージ
+async def _on_engine_message(msg):
+    if msg[0] == market_engine.MSG_TICK:
+        _, ts, changes, fills, updates = msg
+        await _dispatch_tick(changes, fills, updates, ts)
+    elif msg[0] == market_engine.MSG_AUTO_SOLD:
+        _, user_id, result = msg
+        await _notify_auto_sell(user_id, result)
+
+# ティック結果の通知（どちらのモードでも共通）
+async def _dispatch_tick(changes, fills, updates, ts: float):
+    with metrics.timer("vety_tick_stage_seconds", {"stage": "send"}):
         for channel_id, message in updates:
             channel = client.get_channel(channel_id)
             if channel:
                 await channel.send(message)
 
-        stock_manager.cleanup_old_history()  # 古い履歴を削除
+    for fill in fills:
+        if fill["ok"]:
+            price_board.record_volume(fill["symbol"], fill["amount"])
+        asyncio.create_task(_notify_fill(fill))
+    tick_bus.bus.publish(changes, ts)  # 価格変動を購読者へ配信
+
+async def price_update_loop():
+    await client.wait_until_ready()
+
+    while not client.is_closed():
+        try:
+            with metrics.timer("vety_tick_seconds"):
+                # DB処理はスレッドで行い、複数サーバーのティックがイベントループを止めないようにする
+                changes, fills, updates = await asyncio.to_thread(market_engine.run_tick)
+                await _dispatch_tick(changes, fills, updates, time.time())
+        except Exception as e:
+            # 1回の失敗（ロック待ち等）で市場を止めず、次のティックで続ける
+            print(f"❌ 価格更新エラー: {e}")
 
         await asyncio.sleep(1)
 
+# 指値・逆指値の約定通知
+async def _notify_fill(fill: dict):
+    try:
+        user = await client.fetch_user(int(fill["user_id"]))
+    except Exception:
+        return
+    label = order_book.SIDE_LABELS.get(fill["side"], fill["side"])
+    if fill["ok"]:
+        dm_text = (
+            f"🔵 **{label}約定**\n"
+            f"日時: {_now()}\n"
+            f"注文: #{fill['order_id']}\n"
+            f"銘柄: {fill['symbol']}\n"
+            f"数量: {fill['amount']}\n"
+            f"単価: {fill.get('unit_price', '-')}\n"
+            f"合計: {fill.get('total', '-')}\n"
+            f"損益: {fill.get('profit_loss') if fill.get('profit_loss') is not None else '-'}\n"
+        )
+    else:
+        dm_text = (
+            f"⚠️ **{label}注文 #{fill['order_id']} を約定できませんでした**\n"
+            f"理由: {fill['message']}\n"
+        )
+    await _send_dm_safe(user, dm_text)
+
 #株価
 @tree.command(name="株価", description="銘柄の株価グラフを表示します")
-@app_commands.describe(symbol="銘柄コード（例: VELT）")
-@app_commands.autocomplete(symbol=autocomplete_symbols)
+@app_commands.describe(symbol="銘柄コード（例: VELT）、指数は ^MARKET など")
+@app_commands.autocomplete(symbol=autocomplete_chart_symbols)
+@metrics.timed_command
 async def 株価(interaction: discord.Interaction, symbol: str):
     symbol = symbol.upper()
-    filename = f"{symbol}_graph.png"
+    filename = f"{symbol.replace(market_index.INDEX_PREFIX, 'INDEX_')}_graph.png"
     full_path = os.path.join("graphs", filename)
     success = stock_graph.generate_stock_graph(symbol, filename)
 
@@ -84,8 +297,93 @@ async def 株価(interaction: discord.Interaction, symbol: str):
 
     await interaction.response.send_message(file=discord.File(full_path))
 
+#株価比較
+@tree.command(name="株価比較", description="複数銘柄の騰落率を1枚のグラフで比較します")
+@app_commands.describe(symbols="カンマ区切りの銘柄コード（例: VELT,ABC）最大6銘柄")
+@metrics.timed_command
+async def 株価比較(interaction: discord.Interaction, symbols: str):
+    symbol_list = []
+    for s in symbols.replace("、", ",").split(","):
+        s = s.strip().upper()
+        if s and s not in symbol_list:
+            symbol_list.append(s)
+
+    if not 2 <= len(symbol_list) <= 6:
+        await interaction.response.send_message("❌ 2〜6銘柄をカンマ区切りで指定してください。", ephemeral=True)
+        return
+
+    indexes = set(market_index.get_index_symbols("", 1000))
+    unknown = [s for s in symbol_list if s not in indexes and stock_manager.get_price(s) is None]
+    if unknown:
+        await interaction.response.send_message(f"❌ 存在しない銘柄です: {', '.join(unknown)}", ephemeral=True)
+        return
+
+    await interaction.response.defer()
+    # 描画はイベントループを止めないよう executor で行う（to_thread は処理中のサーバーを引き継ぐ）
+    png = await asyncio.to_thread(stock_graph.generate_comparison_graph, symbol_list)
+
+    if png is None:
+        await interaction.followup.send("❌ 履歴が見つかりません。", ephemeral=True)
+        return
+
+    await interaction.followup.send(file=discord.File(io.BytesIO(png), filename="compare.png"))
+
+#履歴エクスポート
+@tree.command(name="履歴エクスポート", description="価格履歴・約定履歴を gzip 圧縮CSVで出力します")
+@app_commands.describe(symbol="銘柄コード", data="出力するデータ（約定履歴は管理者のみ）",
+                       start="開始日 YYYY-MM-DD（省略時は終了日の7日前）", end="終了日 YYYY-MM-DD（省略時は今日）")
+@app_commands.choices(data=[
+    app_commands.Choice(name="価格履歴", value="prices"),
+    app_commands.Choice(name="約定履歴", value="trades"),
+])
+@app_commands.autocomplete(symbol=autocomplete_symbols)
+@metrics.timed_command
+async def 履歴エクスポート(interaction: discord.Interaction, symbol: str, data: app_commands.Choice[str],
+                    start: str = None, end: str = None):
+    if data.value == "trades":
+        allowed_roles = ['終界主', '宰律士']
+        user_roles = [role.name for role in interaction.user.roles]
+
+        if not any(role in allowed_roles for role in user_roles):
+            await interaction.response.send_message("❌ 約定履歴を出力する権限がありません。", ephemeral=True)
+            return
+
+    if not history_export.symbol_exists(symbol):
+        await interaction.response.send_message("❌ 銘柄が存在しません", ephemeral=True)
+        return
+
+    try:
+        start_ts, end_ts = history_export.date_range(start, end)
+    except ValueError as e:
+        await interaction.response.send_message(f"❌ 期間の指定が正しくありません: {e}", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    # 行をページ単位で読みながら一時ファイルへ圧縮して書く（全件をメモリに載せない）
+    path, count = await asyncio.to_thread(
+        history_export.export_csv_gz, data.value, symbol, start_ts, end_ts
+    )
+    try:
+        if count == 0:
+            await interaction.followup.send("❌ 指定期間のデータがありません。", ephemeral=True)
+            return
+
+        limit = interaction.guild.filesize_limit if interaction.guild else 10 * 1024 * 1024
+        size = os.path.getsize(path)
+        if size > limit:
+            await interaction.followup.send(
+                f"❌ ファイルが大きすぎます（{size / 1024 / 1024:.1f}MB / 上限 {limit / 1024 / 1024:.0f}MB）。期間を短くしてください。",
+                ephemeral=True)
+            return
+
+        filename = f"{symbol.upper()}_{data.value}_{start_ts[:10]}_{end_ts[:10]}.csv.gz"
+        await interaction.followup.send(f"📦 {data.name}: {count} 行", file=discord.File(path, filename=filename), ephemeral=True)
+    finally:
+        os.remove(path)
+
 #残高
 @tree.command(name="vety残高を確認する", description="あなたの残高を表示します")
+@metrics.timed_command
 async def 残高(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     user_manager.init_user(user_id)
@@ -95,6 +393,7 @@ async def 残高(interaction: discord.Interaction):
 #発行
 @tree.command(name="vetyを発行する", description="他ユーザーにVetyを発行します（管理者のみ）")
 @app_commands.describe(member="発行先ユーザー", amount="発行額")
+@metrics.timed_command
 async def 発行(interaction: discord.Interaction, member: discord.Member, amount: float):
     allowed_roles = ['終界主', '宰律士']
     user_roles = [role.name for role in interaction.user.roles]
@@ -104,11 +403,38 @@ async def 発行(interaction: discord.Interaction, member: discord.Member, amoun
         return
 
     user_manager.init_user(str(member.id))
-    user_manager.add_balance(str(member.id), amount)
+    user_manager.add_balance(str(member.id), amount, issued_by=str(interaction.user.id))
     await interaction.response.send_message(f"✅ {member.display_name} に {amount} Vety を発行しました。")
 
+#取引履歴
+LEDGER_KIND_LABELS = {
+    ledger.ISSUE: "発行",
+    ledger.BURN: "減額",
+    ledger.TRANSFER: "送金",
+    ledger.BUY: "購入",
+    ledger.SELL: "売却",
+    ledger.REBATE: "還元",
+    ledger.REFUND: "返金",
+}
+
+@tree.command(name="取引履歴", description="あなたのVetyの入出金履歴を表示します")
+@metrics.timed_command
+async def 取引履歴(interaction: discord.Interaction):
+    rows = ledger.get_history(str(interaction.user.id), 15)
+    if not rows:
+        await interaction.response.send_message("📭 取引履歴はありません。", ephemeral=True)
+        return
+
+    msg = "📒 **直近の取引履歴**\n"
+    for ts, kind, amount, counterparty, ref in rows:
+        # 相手勘定（発行元・市場・拘束）は表示せず、銘柄等の参照を出す
+        detail = f"<@{counterparty}>" if counterparty and not ledger.is_system_account(counterparty) else (ref or "")
+        msg += f"・{ts} {LEDGER_KIND_LABELS.get(kind, kind)} {amount:+.0f} Vety {detail}\n"
+    await interaction.response.send_message(msg, ephemeral=True)
+
 #保有銘柄表示
 @tree.command(name="保有", description="現在の保有銘柄を表示します")
+@metrics.timed_command
 async def show_holdings(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     holdings = stock_trading.get_user_holdings(user_id)
@@ -126,9 +452,25 @@ async def show_holdings(interaction: discord.Interaction):
 
 #現在価格表示    
 @tree.command(name="現在価格一覧", description="全銘柄の現在価格を表示します")
+@metrics.timed_command
 async def show_all_prices(interaction: discord.Interaction):
-    message = stock_trading.get_all_current_prices_message()
-    await interaction.response.send_message(message)
+    await interaction.response.send_message(embed=price_board.build_embed("symbol", 0), view=price_board.PriceBoardView())
+
+#市場指数
+@tree.command(name="市場指数", description="市場全体とセクターの指数を表示します")
+@metrics.timed_command
+async def 市場指数(interaction: discord.Interaction):
+    # 指数はティックごとに記録済みなので、ここでは最新値を読むだけ
+    indexes = market_index.get_indexes()
+    msg = "📊 **市場指数**\n"
+    for symbol, weighting, level, open_level in indexes:
+        if level is None:
+            msg += f"・`{symbol}` —（まだ記録がありません）\n"
+            continue
+        change = (level - open_level) / open_level * 100 if open_level else 0.0
+        arrow = "📈" if change > 0 else "📉" if change < 0 else "➖"
+        msg += f"・`{symbol}` {level:,.2f}  {arrow} {change:+.2f}%（{market_index.WEIGHTING_LABELS.get(weighting, weighting)}）\n"
+    await interaction.response.send_message(msg[:1900])
 
 @tree.command(name="銘柄追加", description="新しい銘柄を追加します（管理者のみ）")
 @app_commands.describe(
@@ -140,6 +482,7 @@ async def show_all_prices(interaction: discord.Interaction):
     channel="価格更新を通知するチャンネル",
     user="還元されるユーザー"
 )
+@metrics.timed_command
 async def add_stock_command(
     interaction: discord.Interaction,
     symbol: str,
@@ -157,22 +500,157 @@ async def add_stock_command(
         await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
         return
 
+    if stock_manager.is_reserved_symbol(symbol):
+        await interaction.response.send_message(f"❌ {stock_manager.RESERVED_SYMBOL_MESSAGE}", ephemeral=True)
+        return
+
     # user は還元対象
     user_id = str(user.id)
 
     stock_manager.add_stock(
         symbol.upper(), price, speed, min_fluct, max_fluct, channel.id, user_id
     )
+    _invalidate_engine([symbol.upper()])
+    price_board.invalidate()
 
     await interaction.response.send_message(
         f"✅ 銘柄 `{symbol.upper()}` を追加しました。初期価格: {price}（還元対象: <@{user_id}>）"
     )
 
 
+# 一括処理の進捗表示（executor スレッドから呼ばれる）
+class _ProgressReporter:
+    """スレッドから呼ばれて進捗を応答メッセージに書く。最終結果を書く前に drain() で送信待ちを片付ける"""
+
+    def __init__(self, interaction: discord.Interaction, label: str):
+        self.interaction = interaction
+        self.label = label
+        self.loop = asyncio.get_running_loop()
+        self.last = 0.0
+        self.pending = []
+
+    def __call__(self, done: int, total: int):
+        # 完了時の表示は最終結果で上書きするので送らない
+        now = time.monotonic()
+        if done >= total or now - self.last < 1.0:
+            return
+        self.last = now
+        self.pending.append(asyncio.run_coroutine_threadsafe(
+            self.interaction.edit_original_response(content=f"⏳ {self.label}: {done}/{total}"), self.loop
+        ))
+
+    async def drain(self):
+        # 進捗の編集が最終結果の後に届いて上書きしないよう、送信済みの分を待つ
+        if self.pending:
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in self.pending), return_exceptions=True)
+            self.pending.clear()
+
+#銘柄一括追加
+@tree.command(name="銘柄一括追加", description="CSVから銘柄をまとめて追加します（管理者のみ）")
+@app_commands.describe(
+    file="CSV（ヘッダ: symbol,price,speed,min_fluct,max_fluct[,channel_id,added_by_user_id]）",
+    channel="channel_id 省略時の通知チャンネル",
+    user="added_by_user_id 省略時の還元ユーザー"
+)
+@metrics.timed_command
+async def 銘柄一括追加(
+    interaction: discord.Interaction,
+    file: discord.Attachment,
+    channel: discord.TextChannel | None = None,
+    user: discord.User | None = None
+):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.send_message("⏳ CSVを読み込んでいます…")
+    try:
+        text = (await file.read()).decode("utf-8")
+    except UnicodeDecodeError:
+        await interaction.edit_original_response(content="❌ CSVはUTF-8で保存してください。")
+        return
+
+    rows, errors = await asyncio.to_thread(
+        stock_manager.parse_stock_csv, text,
+        channel.id if channel else None, str(user.id) if user else None
+    )
+    if not rows:
+        await interaction.edit_original_response(content="❌ 追加できる行がありません。\n" + "\n".join(errors[:10]))
+        return
+
+    progress = _ProgressReporter(interaction, "銘柄を追加中")
+    count = await asyncio.to_thread(stock_manager.add_stocks_bulk, rows, progress)
+    await progress.drain()
+    _invalidate_engine([row[0] for row in rows])
+    price_board.invalidate()
+
+    msg = f"✅ {count} 銘柄を追加しました。"
+    if errors:
+        msg += f"\n⚠️ {len(errors)} 行をスキップしました:\n" + "\n".join(errors[:10])
+    await interaction.edit_original_response(content=msg[:1900])
+
+#ロール一括発行・減額
+@tree.command(name="vetyをロールに一括発行する", description="ロールの全メンバーにVetyを発行・減額します（管理者のみ）")
+@app_commands.describe(role="対象ロール", amount="1人あたりの金額", mode="発行または減額")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="発行", value="issue"),
+    app_commands.Choice(name="減額", value="burn"),
+])
+@metrics.timed_command
+async def ロール一括発行(interaction: discord.Interaction, role: discord.Role, amount: float, mode: app_commands.Choice[str]):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [r.name for r in interaction.user.roles]
+
+    if not any(r in allowed_roles for r in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    if amount <= 0:
+        await interaction.response.send_message("❌ 正の数を入力してください。", ephemeral=True)
+        return
+
+    # role.members はメンバー一覧のキャッシュから作られるため、不完全なら一部の人だけに発行してしまう
+    guild = interaction.guild
+    if guild is None or not interaction.client.intents.members:
+        await interaction.response.send_message(
+            "❌ Server Members Intent が無効のため、ロールの全メンバーを取得できません（DISCORD_MEMBERS_INTENT=1 が必要です）。",
+            ephemeral=True)
+        return
+
+    await interaction.response.send_message("⏳ メンバー一覧を取得しています…")
+    if not guild.chunked:
+        try:
+            await guild.chunk()
+        except discord.ClientException as e:
+            await interaction.edit_original_response(content=f"❌ メンバー一覧を取得できませんでした: {e}")
+            return
+
+    member_ids = [str(m.id) for m in role.members if not m.bot]
+    if not member_ids:
+        await interaction.edit_original_response(content="❌ 対象のメンバーが見つかりません。")
+        return
+
+    await interaction.edit_original_response(content=f"⏳ {len(member_ids)} 人を処理しています…")
+    signed = amount if mode.value == "issue" else -amount
+    progress = _ProgressReporter(interaction, f"{mode.name}中")
+    done, skipped = await asyncio.to_thread(
+        user_manager.bulk_adjust, member_ids, signed, str(interaction.user.id), progress
+    )
+    await progress.drain()
+
+    msg = f"✅ {role.name} の {done} 人に {amount} Vety を{mode.name}しました。"
+    if skipped:
+        msg += f"（残高不足で {skipped} 人をスキップ）"
+    await interaction.edit_original_response(content=msg)
+
 #銘柄削除
 @tree.command(name="銘柄削除", description="銘柄を削除します（管理者のみ）")
 @app_commands.describe(symbol="削除したい銘柄名（例: VELT）")
 @app_commands.autocomplete(symbol=autocomplete_symbols)
+@metrics.timed_command
 async def delete_stock_command(interaction: discord.Interaction, symbol: str):
     allowed_roles = ['終界主', '宰律士']
     user_roles = [role.name for role in interaction.user.roles]
@@ -182,24 +660,83 @@ async def delete_stock_command(interaction: discord.Interaction, symbol: str):
         return
 
     stock_manager.delete_stock(symbol.upper())
+    engine = engines.get(guilds.partition())
+    if engine is not None:
+        engine.reload_orders(symbol.upper())  # エンジン側の板からも外す
+    _invalidate_engine([symbol.upper()])
+    price_board.invalidate()
     await interaction.response.send_message(f"🗑 銘柄 `{symbol.upper()}` を削除しました。")
 
+#セクター作成
+@tree.command(name="セクター作成", description="セクター指数を作成します（管理者のみ）")
+@app_commands.describe(name="セクター名（英数字、例: TECH）", weighting="指数の加重方式")
+@app_commands.choices(weighting=[
+    app_commands.Choice(name="価格加重", value=market_index.PRICE_WEIGHTED),
+    app_commands.Choice(name="時価総額加重", value=market_index.CAP_WEIGHTED),
+])
+@metrics.timed_command
+async def セクター作成(interaction: discord.Interaction, name: str, weighting: app_commands.Choice[str]):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.send_message(market_index.create_sector(name, weighting.value))
+
+#セクター構成
+@tree.command(name="セクター構成", description="セクターの構成銘柄を設定します（管理者のみ）")
+@app_commands.describe(name="セクター名", symbols="カンマ区切りの銘柄コード。時価総額加重では 銘柄:株数（例: VELT:500,ABC:200）")
+@metrics.timed_command
+async def セクター構成(interaction: discord.Interaction, name: str, symbols: str):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    try:
+        members = market_index.parse_members(symbols)
+    except ValueError as e:
+        await interaction.response.send_message(f"❌ 銘柄の指定が正しくありません: {e}", ephemeral=True)
+        return
+    await interaction.response.send_message(market_index.set_members(name, members))
+
+#セクター削除
+@tree.command(name="セクター削除", description="セクター指数を削除します（管理者のみ）")
+@app_commands.describe(name="セクター名")
+@metrics.timed_command
+async def セクター削除(interaction: discord.Interaction, name: str):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.send_message(market_index.delete_sector(name))
+
 #銘柄を買う
 @tree.command(name="銘柄を買う", description="指定した銘柄を購入します")
 @app_commands.describe(symbol="銘柄名（例: VELT）", amount="購入口数", auto_sell_minutes="何分後に自動売却（0で手動）")
 @app_commands.autocomplete(symbol=autocomplete_symbols)
+@metrics.timed_command
 async def 買う(interaction: discord.Interaction, symbol: str, amount: int, auto_sell_minutes: int):
+    if not await _admit(interaction, "buy"):
+        return
     user_id = str(interaction.user.id)
     stock_trading.init_user(user_id)
     symbol_up = symbol.upper()
 
-    # 購入直前に現在価格（単価）を取得
-    unit_price = stock_manager.get_current_price(symbol_up)
-
-    message = stock_trading.buy_stock(user_id, symbol_up, amount, auto_sell_minutes)
-    await interaction.response.send_message(message, ephemeral=True)
+    result = stock_trading.buy_stock(user_id, symbol_up, amount, auto_sell_minutes)
+    if result["ok"]:
+        price_board.record_volume(symbol_up, result["amount"])
+    await interaction.response.send_message(result["message"], ephemeral=True)
 
     # ✅ DMログ
+    unit_price = result["unit_price"]
     if unit_price is not None:
         total = unit_price * amount
         dm_text = (
@@ -226,12 +763,17 @@ async def 買う(interaction: discord.Interaction, symbol: str, amount: int, aut
 @tree.command(name="銘柄を売る", description="保有している銘柄を売却します")
 @app_commands.describe(symbol="銘柄名（例: VELT）", amount="売却する口数（空欄なら全数）")
 @app_commands.autocomplete(symbol=autocomplete_symbols)
+@metrics.timed_command
 async def 売る(interaction: discord.Interaction, symbol: str, amount: int):
+    if not await _admit(interaction, "sell"):
+        return
     user_id = str(interaction.user.id)
     symbol_up = symbol.upper()
     try:
         # 手動売却なので auto=False
         result = await stock_trading.sell_stock_async(user_id, symbol_up, amount, auto=False)
+        if result["ok"]:
+            price_board.record_volume(result["symbol"], result["amount"])
         await interaction.response.send_message(result["message"], ephemeral=True)
 
         dm_text = (
@@ -250,45 +792,160 @@ async def 売る(interaction: discord.Interaction, symbol: str, amount: int):
         traceback.print_exc()
         await interaction.response.send_message(f"エラーが発生しました: {e}", ephemeral=True)
 
+#指値・逆指値注文
+@tree.command(name="指値注文", description="指値買い・指値売り・逆指値売りの注文を出します")
+@app_commands.describe(symbol="銘柄名（例: VELT）", order_type="注文種別", amount="注文口数", price="指値（逆指値）")
+@app_commands.choices(order_type=[
+    app_commands.Choice(name="指値買い", value=order_book.LIMIT_BUY),
+    app_commands.Choice(name="指値売り", value=order_book.LIMIT_SELL),
+    app_commands.Choice(name="逆指値売り", value=order_book.STOP_LOSS),
+])
+@app_commands.autocomplete(symbol=autocomplete_symbols)
+@metrics.timed_command
+async def 指値注文(interaction: discord.Interaction, symbol: str, order_type: app_commands.Choice[str], amount: int, price: int):
+    if not await _admit(interaction, "order"):
+        return
+    user_id = str(interaction.user.id)
+    stock_trading.init_user(user_id)
+    message = order_book.place_order(user_id, symbol.upper(), order_type.value, amount, price)
+    engine = engines.get(guilds.partition())
+    if engine is not None:
+        engine.reload_orders(symbol.upper())  # 板はエンジン側のプロセスにある
+    await interaction.response.send_message(message, ephemeral=True)
+
+#注文一覧
+@tree.command(name="注文一覧", description="未約定の指値・逆指値注文を表示します")
+@metrics.timed_command
+async def 注文一覧(interaction: discord.Interaction):
+    orders = order_book.get_user_orders(str(interaction.user.id))
+    if not orders:
+        await interaction.response.send_message("📭 未約定の注文はありません。", ephemeral=True)
+        return
+
+    msg = "📝 **未約定の注文**\n"
+    for order_id, symbol, side, amount, limit_price in orders:
+        msg += f"・#{order_id} {symbol} {order_book.SIDE_LABELS.get(side, side)} {limit_price}Vety × {amount}口\n"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+#注文取消
+@tree.command(name="注文取消", description="未約定の注文を取り消します")
+@app_commands.describe(order_id="注文番号")
+@metrics.timed_command
+async def 注文取消(interaction: discord.Interaction, order_id: int):
+    message = order_book.cancel_order(str(interaction.user.id), order_id)
+    await interaction.response.send_message(message, ephemeral=True)
+
 # 自動売却ループ（変更不要）
 async def auto_sell_loop(client):
     await client.wait_until_ready()
 
     while not client.is_closed():
         await asyncio.sleep(30)
-        now = datetime.now().isoformat()
-
-        with stock_trading.get_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
-                SELECT user_id, symbol, amount FROM user_stocks
-                WHERE auto_sell_time IS NOT NULL AND auto_sell_time <= ?
-            """, (now,))
-            rows = c.fetchall()
+        try:
+            rows = await asyncio.to_thread(market_engine.due_auto_sells)
+        except Exception as e:
+            print(f"❌ 自動売却エラー: {e}")
+            continue
 
         for user_id, symbol, amount in rows:
             try:
                 result = await stock_trading.sell_stock_async(user_id, symbol, amount, auto=True)
-                user = await client.fetch_user(int(user_id))
-
-                dm_text = (
-                    "🟡 **自動売却履歴**\n"
-                    f"日時: {_now()}\n"
-                    f"銘柄: {result['symbol']}\n"
-                    f"数量: {result['amount']}\n"
-                    f"単価: {result.get('unit_price', '-')}\n"
-                    f"合計: {result.get('total', '-')}\n"
-                    f"損益: {result.get('profit_loss', '-')}\n"
-                )
-                await _send_dm_safe(user, dm_text)            
-                
+                await _notify_auto_sell(user_id, result)
             except Exception as e:
                 print(f"❌ 自動売却エラー: {e}")
 
+async def _notify_auto_sell(user_id: str, result: dict):
+    if result["ok"]:
+        price_board.record_volume(result["symbol"], result["amount"])
+    try:
+        user = await client.fetch_user(int(user_id))
+    except Exception as e:
+        print(f"❌ 自動売却エラー: {e}")
+        return
+
+    dm_text = (
+        "🟡 **自動売却履歴**\n"
+        f"日時: {_now()}\n"
+        f"銘柄: {result['symbol']}\n"
+        f"数量: {result['amount']}\n"
+        f"単価: {result.get('unit_price', '-')}\n"
+        f"合計: {result.get('total', '-')}\n"
+        f"損益: {result.get('profit_loss', '-')}\n"
+    )
+    await _send_dm_safe(user, dm_text)
+
+#メトリクス
+@tree.command(name="メトリクス", description="処理時間などの計測結果を表示します（管理者のみ）")
+@metrics.timed_command
+async def メトリクス(interaction: discord.Interaction):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    text = metrics.summary()
+    if len(text) > 1900:
+        # 長い場合は Prometheus 形式の全文を添付する
+        file = discord.File(io.BytesIO(metrics.render().encode()), filename="metrics.txt")
+        await interaction.response.send_message(text[:1900] + "\n…", file=file, ephemeral=True)
+        return
+    await interaction.response.send_message(text, ephemeral=True)
+
+#プロファイル
+@tree.command(name="プロファイル", description="稼働中のボットまたは市場エンジンを指定秒数サンプリングします（管理者のみ）")
+@app_commands.describe(seconds="計測する秒数（1〜60）",
+                       target="計測対象（市場エンジンは MARKET_ENGINE=process で別プロセスの時だけ）")
+@app_commands.choices(target=[
+    app_commands.Choice(name="ボット", value="bot"),
+    app_commands.Choice(name="市場エンジン", value="engine"),
+])
+@metrics.timed_command
+async def プロファイル(interaction: discord.Interaction, seconds: int = 10,
+                   target: app_commands.Choice[str] | None = None):
+    allowed_roles = ['終界主', '宰律士']
+    user_roles = [role.name for role in interaction.user.roles]
+
+    if not any(role in allowed_roles for role in user_roles):
+        await interaction.response.send_message("❌ このコマンドを使う権限がありません。", ephemeral=True)
+        return
+
+    engine = None
+    if target is not None and target.value == "engine":
+        engine = engines.get(guilds.partition())
+        if engine is None:
+            # 同一プロセスのエンジンはボット側の計測に含まれる
+            await interaction.response.send_message(
+                "❌ このサーバーの市場エンジンは別プロセスで動いていません。ボットを計測してください。", ephemeral=True)
+            return
+
+    await interaction.response.defer(ephemeral=True)
+    if engine is not None:
+        result = await engine.profile(seconds)
+    else:
+        # サンプラーは専用スレッドで動かし、イベントループは普段通り動かし続ける
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, profiler.run, seconds)
+    if result is None:
+        await interaction.followup.send("⏳ 別のプロファイルを実行中です。", ephemeral=True)
+        return
+
+    report, top, samples = result
+    label = "市場エンジン" if engine is not None else "ボット"
+    msg = f"🔬 **プロファイル結果**（{label}・{samples} サンプル）\n"
+    for name, pct in top:
+        msg += f"・{pct:5.1f}% {name}\n"
+    file = discord.File(io.BytesIO(report.encode()), filename=f"profile_{datetime.now():%Y%m%d_%H%M%S}.collapsed.txt")
+    await interaction.followup.send(msg[:1900], file=file, ephemeral=True)
+
 # 送金コマンド
 @tree.command(name="vetyを送金する", description="他ユーザーにVetyを送金します")
 @app_commands.describe(member="送金先ユーザー", amount="送金額")
+@metrics.timed_command
 async def 送金(interaction: discord.Interaction, member: discord.Member, amount: float):
+    if not await _admit(interaction, "transfer"):
+        return
     from_id = str(interaction.user.id)
     to_id = str(member.id)
 
@@ -312,6 +969,7 @@ async def 送金(interaction: discord.Interaction, member: discord.Member, amoun
 # 減額コマンド
 @tree.command(name="vetyを減額する", description="指定ユーザーのVetyを減額します（管理者のみ）")
 @app_commands.describe(member="対象ユーザー", amount="減額額")
+@metrics.timed_command
 async def 減額(interaction: discord.Interaction, member: discord.Member, amount: float):
     allowed_roles = ['終界主', '宰律士']
     user_roles = [role.name for role in interaction.user.roles]
@@ -333,4 +991,5 @@ async def 減額(interaction: discord.Interaction, member: discord.Member, amoun
     else:
         await interaction.response.send_message("❌ 減額に失敗しました（残高不足の可能性あり）。", ephemeral=True)
 
-client.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    client.run(TOKEN)